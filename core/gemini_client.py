@@ -1,16 +1,44 @@
 import os
 import re
 import random
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import google.generativeai as genai
-from typing import List, Optional, Dict, Any, Tuple
+from google.api_core import exceptions as google_exceptions, retry as google_retry
+from types import MappingProxyType
+from typing import List, Optional, Dict, Any, Tuple, Iterable, Iterator
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
-GRIEF_KEYWORDS = frozenset(["died", "passed", "funeral",
-                           "miss", "pet", "dog", "cat", "tiger", "rainbow bridge"])
-HIGH_DISTRESS = frozenset(["sadness", "grief", "despair", "anxiety", "fear"])
+# Loss language for the grief check ("lost" also covers "lost my")
+GRIEF_KEYWORDS = frozenset(["died", "passed", "funeral", "death", "lost", "miss"])
+# RoBERTa (go_emotions) labels that always warrant a Gemini assessment
+HIGH_DISTRESS = frozenset(["sadness", "grief", "despair", "anxiety", "fear",
+                          "nervousness", "remorse", "anger"])
+
+# EXPLICIT CRISIS MARKERS - these are unambiguous danger signals
+EXPLICIT_CRISIS_MARKERS = {
+    "suicide": [
+        "kill myself", "killing myself", "want to die",
+        "should die", "end my life", "end it all", "end it", "take my life",
+        "suicide", "suicidal", "commit suicide"
+    ],
+    "self_harm": [
+        "cut myself", "cutting myself", "cutting", "self-harm", "self harm",
+        "hurt myself", "hurting myself", "harm myself"
+    ],
+    "methods": [
+        "overdose", "rope", "pills", "jump", "hanging", "wrist"
+    ],
+    "hopelessness_with_intent": [
+        "no point in living", "better off dead", "everyone would be better off if i",
+        "shouldn't be alive", "don't deserve to live"
+    ]
+}
 
 PHILIPPINE_CRISIS_RESOURCES = {
     "national_hotlines": [
@@ -25,16 +53,153 @@ PHILIPPINE_CRISIS_RESOURCES = {
     "emergency": "**Emergency Services**: 911"
 }
 
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Crisis resource blocks, built once from PHILIPPINE_CRISIS_RESOURCES
+CRISIS_RESOURCES_TEXT = (
+    "**🆘 IMMEDIATE HELP - PHILIPPINES CRISIS HOTLINES:**\n\n"
+    + "".join(f"• {hotline}\n" for hotline in PHILIPPINE_CRISIS_RESOURCES["national_hotlines"])
+    + f"\n• {PHILIPPINE_CRISIS_RESOURCES['emergency']}\n\n"
+    + "**Regional Support:**\n"
+    + "".join(f"• {hotline}\n" for hotline in PHILIPPINE_CRISIS_RESOURCES["regional_hotlines"])
+    + "\n**These are all FREE, confidential, and available 24/7.**"
+)
+DISTRESS_RESOURCES_TEXT = "\n".join(
+    PHILIPPINE_CRISIS_RESOURCES["national_hotlines"]) + "\n" + PHILIPPINE_CRISIS_RESOURCES["emergency"]
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+if not GEMINI_API_KEY:
+    logger.warning("GEMINI_API_KEY is not set - Gemini calls will fail and replies will use fallbacks")
+# The SDK keeps one client per process, shared by both models; pin gRPC so every call
+# reuses that client's long-lived HTTP/2 channel instead of per-call REST connections
+genai.configure(api_key=GEMINI_API_KEY, transport="grpc")
 model = genai.GenerativeModel("gemini-2.0-flash")
+# One-word classification does not need the full reply model
+assessment_model = genai.GenerativeModel("gemini-2.0-flash-lite")
+
+# Shared call settings; the SDK copies these per request, so module-level dicts are safe
+# Brief retries for transient server errors only; quota and client errors fail fast
+TRANSIENT_RETRY = google_retry.Retry(
+    predicate=google_retry.if_exception_type(
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+    ),
+    initial=0.3,
+    multiplier=2,
+    maximum=1.2,
+    timeout=12,
+)
+REQUEST_OPTIONS = {"timeout": 10, "retry": TRANSIENT_RETRY}
+# Summaries are refreshed in the background, so they can wait a little longer
+SUMMARY_REQUEST_OPTIONS = {"timeout": 20, "retry": TRANSIENT_RETRY}
+# A streamed reply's deadline covers the whole stream, so this is its wall-clock cap
+STREAM_REQUEST_OPTIONS = {"timeout": 20, "retry": TRANSIENT_RETRY}
+ASSESS_GENERATION_CONFIG = {
+    "temperature": 0.1,  # Low temperature for consistent classification
+    # A single label ("HIGH_DISTRESS" is the longest) fits in a handful of tokens;
+    # stop at the first line break instead of letting the model elaborate
+    "max_output_tokens": 8,
+    "stop_sequences": ["\n"],
+}
+REPLY_GENERATION_CONFIG = {"temperature": 0.7, "max_output_tokens": 600}
+DISTRESS_GENERATION_CONFIG = {"temperature": 0.7, "max_output_tokens": 700}
+CRISIS_GENERATION_CONFIG = {"temperature": 0.7, "max_output_tokens": 1000}
+
+# Request threads per gunicorn worker process (gthread); pools are sized so every
+# request thread can have its background Gemini calls in flight at once
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "8"))
+# Threads for speculative normal replies and bounded crisis replies (one of each per request)
+_gemini_executor = ThreadPoolExecutor(max_workers=2 * GUNICORN_THREADS, thread_name_prefix="enoki-gemini")
+# Classifications and their hedges get their own pool, so a hedge never waits behind
+# a long reply generation (original + duplicate per request)
+_classify_executor = ThreadPoolExecutor(max_workers=2 * GUNICORN_THREADS, thread_name_prefix="enoki-classify")
+# A classification slower than this gets one duplicate request; the first answer wins
+CLASSIFY_HEDGE_AFTER = 1.5
+# Crisis turns wait at most this long for Gemini's first chunk before sending the
+# canned crisis reply (on generate_reply too, which streams crisis replies internally)
+CRISIS_REPLY_DEADLINE = 1.0
+
+
+def _hedged(call, hedge_after: float):
+    """
+    Run call() on the classification pool; if it has not finished after hedge_after seconds,
+    start one duplicate and return whichever succeeds first. Raises if both fail.
+    """
+    first = _classify_executor.submit(call)
+    done, _ = wait([first], timeout=hedge_after)
+    if done:
+        return first.result()
+
+    pending = {first, _classify_executor.submit(call)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+# Rate limits, timeouts and overloads are expected now and then; the caller's fallback
+# covers them, so they are logged as warnings rather than errors
+TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.RetryError,
+    TimeoutError,
+)
+
+
+def _log_gemini_failure(action: str, error: Exception) -> None:
+    """Log a failed Gemini call that the caller is about to replace with a fallback."""
+    if isinstance(error, TRANSIENT_GEMINI_ERRORS):
+        logger.warning(f"{action} failed with a transient {type(error).__name__}: {str(error)}")
+    else:
+        logger.error(f"{action} failed with {type(error).__name__}: {str(error)}")
+
+
+# Whitespace that follows a sentence-ending mark
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
 
 
 def add_breaks(text: str, max_sentences=4) -> str:
     """Add paragraph breaks every 4 sentences to maintain readability without breaking flow."""
-    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
-    paragraphs = [' '.join(sentences[i:i+max_sentences])
-                  for i in range(0, len(sentences), max_sentences)]
-    return '\n\n'.join(paragraphs)
+    # re.split runs in C; a Python-level scanner or islice grouping measured slower
+    sentences = _SENT_SPLIT.split(text.strip())
+    return '\n\n'.join(' '.join(sentences[i:i + max_sentences])
+                       for i in range(0, len(sentences), max_sentences))
+
+
+def stream_sentences(chunks: Iterable[str], max_sentences=4) -> Iterator[str]:
+    """
+    Incremental add_breaks: yield each sentence as soon as it is complete, prefixed
+    with the separator add_breaks would put before it (' ' or '\\n\\n'), so the pieces
+    concatenate to exactly add_breaks(full_text).
+    """
+    pending = ""
+    count = 0
+    for chunk in chunks:
+        pending += chunk
+        if not count:
+            pending = pending.lstrip()
+        # A boundary only counts once text follows it; trailing whitespace may still grow
+        match = _SENT_SPLIT.search(pending)
+        while match and match.end() < len(pending):
+            yield _sentence_separator(count, max_sentences) + pending[:match.start()]
+            count += 1
+            pending = pending[match.end():]
+            match = _SENT_SPLIT.search(pending)
+
+    tail = pending.strip()
+    if tail:
+        yield _sentence_separator(count, max_sentences) + tail
+
+
+def _sentence_separator(index: int, max_sentences: int) -> str:
+    if not index:
+        return ''
+    return '\n\n' if index % max_sentences == 0 else ' '
 
 
 def safe_get_response_text(response) -> str:
@@ -59,73 +224,165 @@ def safe_get_response_text(response) -> str:
     return ""
 
 
-def assess_response_type(user_text: str, emotions: List[Dict[str, float]]) -> str:
+def iter_response_text(response) -> Iterator[str]:
+    """Yield the text of each streamed Gemini chunk, skipping blocked/empty chunks."""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except Exception as e:
+            logger.warning(f"Could not extract streamed chunk text: {str(e)}")
+            continue
+        if text:
+            yield text
+
+
+def _keyword_index(tag_words: Dict[str, Iterable[str]],
+                   whole_word_tags: Iterable[str] = (),
+                   word_start_tags: Iterable[str] = ()) -> Tuple[re.Pattern, Dict[str, frozenset]]:
     """
-    Use Gemini to intelligently determine response type, considering RoBERTa emotions.
-    Returns response type: immediate_danger, grief, panic, high_distress, or normal
-    
-    STEP 1: Check for explicit crisis keywords first (safety-first approach)
-    STEP 2: Use Gemini for nuanced assessment if not clearly a crisis
+    Compile tagged substring keywords into one scanning pattern plus a word -> tags map.
+    The pattern is a zero-width lookahead, so overlapping keywords are all found, and
+    alternatives are tried longest first; each keyword therefore also carries the tags
+    of any keyword that is a prefix of it. Keywords of whole_word_tags only match whole
+    words and those of word_start_tags only at the start of a word, so a prefix may not
+    have a stricter boundary than the keywords it is a prefix of.
     """
-    # ============ STEP 1: EXPLICIT CRISIS KEYWORD CHECK ============
-    # This catches obvious self-harm/suicide mentions BEFORE Gemini
-    # to prevent over-interpretation of user intent
-    
-    user_lower = user_text.lower()
-    
-    # EXPLICIT CRISIS MARKERS - these are unambiguous danger signals
-    explicit_crisis_markers = {
-        "suicide": [
-            "kill myself", "kill myself", "killing myself", "want to die", 
-            "should die", "end my life", "end it all", "end it", "take my life",
-            "suicide", "suicidal", "commit suicide"
-        ],
-        "self_harm": [
-            "cut myself", "cutting myself", "cutting", "self-harm", "self harm",
-            "hurt myself", "hurting myself", "harm myself"
-        ],
-        "methods": [
-            "overdose", "rope", "pills", "jump", "hanging", "wrist"
-        ],
-        "hopelessness_with_intent": [
-            "no point in living", "better off dead", "everyone would be better off if i",
-            "shouldn't be alive", "don't deserve to live"
-        ]
+    whole_word_tags = frozenset(whole_word_tags)
+    word_start_tags = frozenset(word_start_tags) | whole_word_tags
+    bounds = {}
+    for tag, tagged in tag_words.items():
+        mode = (tag in word_start_tags, tag in whole_word_tags)
+        for word in tagged:
+            if bounds.setdefault(word, mode) != mode:
+                raise ValueError(f"Keyword {word!r} has conflicting word boundaries")
+    for word, (starts, _) in bounds.items():
+        for other, (other_starts, other_ends) in bounds.items():
+            if other != word and word.startswith(other) and (other_ends or other_starts > starts):
+                raise ValueError(f"Keyword {other!r} is a prefix of {word!r} with a stricter boundary")
+    word_tags = {
+        word: frozenset(tag for tag, tagged in tag_words.items()
+                        if any(word.startswith(other) for other in tagged))
+        for word in bounds
     }
-    
-    # Check for explicit markers
-    for category, markers in explicit_crisis_markers.items():
-        for marker in markers:
-            if marker in user_lower:
-                logger.warning(f"🚨 EXPLICIT CRISIS MARKER DETECTED ({category}): '{marker}' in message")
-                return "immediate_danger"
-    
-    # ============ STEP 2: EMOTION-BASED CHECK ============
-    # If high sadness + specific loss keywords = GRIEF (not crisis)
-    if emotions and len(emotions) > 0:
-        top_emotion = emotions[0].get('label', '').lower()
-        score = emotions[0].get('score', 0)
-        
-        # Grief detection - specific loss language
-        grief_keywords = ["died", "passed", "funeral", "death", "lost", "lost my", "miss"]
-        if top_emotion == 'sadness' and score > 0.7 and any(kw in user_lower for kw in grief_keywords):
-            logger.info(f"Response type: GRIEF (sadness + loss keywords)")
-            return "grief"
-    
-    # Extract emotion context from RoBERTa
-    emotion_data = []
-    for emotion in emotions[:3]:
-        label = emotion.get('label', 'unknown')
+    pattern = re.compile('(?=(' + '|'.join(
+        (r'\b' if bounds[word][0] else '') + re.escape(word) + (r'\b' if bounds[word][1] else '')
+        for word in sorted(bounds, key=len, reverse=True)) + '))')
+    return pattern, word_tags
+
+
+# Only these bare greetings and acknowledgements skip the Gemini classification, and only
+# when RoBERTa confidently reports no distress; anything else is classified
+TRIVIAL_MESSAGES = frozenset([
+    "hi", "hii", "hello", "hey", "heya", "yo", "hi there", "hello there", "hey there",
+    "good morning", "good afternoon", "good evening", "morning",
+    "thanks", "thank you", "thank you so much", "thanks a lot", "ty", "tysm",
+    "ok", "okay", "k", "kk", "cool", "nice", "great", "got it", "alright", "sure",
+    "lol", "haha", "hahaha", "bye", "goodbye", "see you", "good night", "gn",
+])
+# A top emotion below this score tells the prefilter nothing, so the message is classified
+PREFILTER_EMOTION_SCORE = 0.35
+ESCALATION_TERMS = [
+    # panic
+    "breath", "heart", "racing", "panic", "shaking", "chest", "dizzy", "hyperventilat",
+    # loss
+    "grief", "grieving", "funeral", "died", "death", "passed", "lost", "miss",
+    # hopelessness and distress
+    "hopeless", "pointless", "worthless", "trapped", "cope", "give up", "giving up",
+    "no point", "alone", "empty", "numb", "overwhelm", "exhausted", "tired of",
+    "hurt", "pain", "scared", "afraid", "terrified", "anxi", "depress", "cry", "crying",
+    # self-harm adjacent
+    "die", "dying", "kill", "harm", "cut", "suicid", "end it",
+]
+
+# Every keyword the assessment looks at, tagged by crisis category, grief or escalation
+ASSESS_RE, ASSESS_WORD_TAGS = _keyword_index({
+    **EXPLICIT_CRISIS_MARKERS,
+    "grief": GRIEF_KEYWORDS,
+    "escalation": ESCALATION_TERMS,
+})
+
+
+def _scan_message(user_lower: str) -> Tuple[frozenset, Optional[Tuple[str, str]]]:
+    """
+    One pass over the message: (every keyword tag hit, (category, marker) for the
+    earliest explicit crisis marker or None).
+    """
+    tags = set()
+    crisis_marker = None
+    for match in ASSESS_RE.finditer(user_lower):
+        word_tags = ASSESS_WORD_TAGS[match.group(1)]
+        if crisis_marker is None:
+            category = next((c for c in EXPLICIT_CRISIS_MARKERS if c in word_tags), None)
+            if category:
+                crisis_marker = (category, match.group(1))
+        tags |= word_tags
+    return frozenset(tags), crisis_marker
+
+
+def _summarize_emotions(emotions: List[Dict[str, float]]) -> Tuple[str, str, bool]:
+    """
+    One pass over the RoBERTa scores.
+    Returns (assessment summary, prompt emotion context, strong distress present).
+    """
+    summary_parts = []
+    main_emotions = []
+    distressed = False
+    for index, emotion in enumerate(emotions):
+        label = emotion.get('label', '')
         score = emotion.get('score', 0)
-        if score > 0.2:  # Only include emotions with reasonable confidence
-            emotion_data.append(f"{label} ({score:.2f})")
-    
-    emotion_summary = ", ".join(emotion_data) if emotion_data else "neutral emotions"
-    
-    # ============ STEP 3: GEMINI ASSESSMENT FOR EDGE CASES ============
-    # Only use Gemini for nuanced assessment if no explicit markers found
-    # This prevents over-interpretation while catching subtle crises
-    
+        if index < 3:
+            if score > 0.2:  # Only include emotions with reasonable confidence
+                summary_parts.append(f"{label or 'unknown'} ({score:.2f})")
+            if score > 0.3:
+                main_emotions.append(label)
+        if not distressed and score >= PREFILTER_EMOTION_SCORE and label.lower() in HIGH_DISTRESS:
+            distressed = True
+    emotion_summary = ", ".join(summary_parts) if summary_parts else "neutral emotions"
+    emotion_context = ", ".join(main_emotions) if main_emotions else "just feeling regular"
+    return emotion_summary, emotion_context, distressed
+
+
+def _needs_assessment(stripped_text: str, escalation: bool, distressed: bool, top_score: float) -> bool:
+    """
+    Whether the message is worth a Gemini call: everything except a bare greeting or
+    acknowledgement that comes with a confident, non-distressed emotion reading.
+    """
+    if escalation or distressed or top_score < PREFILTER_EMOTION_SCORE:
+        return True
+    # Only calm messages get here, so the lowercase copy is rarely made
+    return " ".join(re.sub(r"[^a-z' ]", " ", stripped_text.lower()).split()) not in TRIVIAL_MESSAGES
+
+
+# Classifications by (message digest, emotion summary); no message text is kept
+CLASSIFY_CACHE_SIZE = 2048
+_classify_cache: "OrderedDict[Tuple[bytes, str], Optional[str]]" = OrderedDict()
+_classify_cache_lock = threading.Lock()
+
+
+def _classify_with_gemini(user_text: str, emotion_summary: str) -> Optional[str]:
+    """
+    _request_classification, cached per (whitespace-normalised message, emotions).
+    Failures raise and are not cached.
+    """
+    key = (hashlib.blake2b(user_text.encode(), digest_size=16).digest(), emotion_summary)
+    with _classify_cache_lock:
+        if key in _classify_cache:
+            _classify_cache.move_to_end(key)
+            return _classify_cache[key]
+
+    assessment = _request_classification(user_text, emotion_summary)
+    with _classify_cache_lock:
+        _classify_cache[key] = assessment
+        while len(_classify_cache) > CLASSIFY_CACHE_SIZE:
+            _classify_cache.popitem(last=False)
+    return assessment
+
+
+def _request_classification(user_text: str, emotion_summary: str) -> Optional[str]:
+    """
+    Ask Gemini for PANIC/GRIEF/HIGH_DISTRESS/NORMAL and return it lowercased, or None
+    if the answer is unclear.
+    """
     assessment_prompt = f"""You are a mental health assessment expert. Your task is to classify the user's emotional state.
 
 Message: "{user_text}"
@@ -174,161 +431,215 @@ GRIEF
 HIGH_DISTRESS
 NORMAL"""
 
-    try:
-        response = model.generate_content(
+    response = _hedged(
+        lambda: assessment_model.generate_content(
             assessment_prompt,
-            generation_config={
-                "temperature": 0.1,  # Low temperature for consistent classification
-                "max_output_tokens": 30
-            },
-            request_options={"timeout": 10}
-        )
-
-        assessment = response.text.strip().upper()
-        logger.info(
-            f"Response type assessment: {assessment} | Emotions: {emotion_summary} | Message: {user_text[:50]}...")
-
-        # Extract the response type from the response
-        valid_types = ["PANIC", "GRIEF", "HIGH_DISTRESS", "NORMAL"]
-        for resp_type in valid_types:
-            if resp_type in assessment:
-                return resp_type.lower()
-
-        # Fallback: If Gemini doesn't classify clearly, use emotions
-        if emotions and len(emotions) > 0:
-            top_emotion = emotions[0].get('label', '').lower()
-            score = emotions[0].get('score', 0)
-            if score > 0.7:
-                if top_emotion == 'fear':
-                    logger.info(f"Fallback to panic based on high fear emotion")
-                    return "panic"
-                elif top_emotion == 'sadness':
-                    logger.info(f"Fallback to high_distress based on high sadness emotion")
-                    return "high_distress"
-        
-        return "normal"
+            generation_config=ASSESS_GENERATION_CONFIG,
+            request_options=REQUEST_OPTIONS
+        ),
+        CLASSIFY_HEDGE_AFTER,
+    )
 
-    except Exception as e:
-        logger.error(f"Response type assessment failed: {str(e)}")
-        # Fallback: Use RoBERTa emotions to make a safe guess
-        if emotions and len(emotions) > 0:
-            top_emotion = emotions[0].get('label', '').lower()
-            score = emotions[0].get('score', 0)
-            if score > 0.6:
-                if top_emotion == 'fear':
-                    logger.info(f"Exception fallback to panic based on {top_emotion}")
-                    return "panic"
-                elif top_emotion in ['sadness', 'anger']:
-                    logger.info(f"Exception fallback to high_distress based on {top_emotion}")
-                    return "high_distress"
-        return "normal"
+    assessment = response.text.strip().upper()
+    logger.info(
+        f"Response type assessment: {assessment} | Emotions: {emotion_summary} | Message: {user_text[:50]}...")
 
+    # Extract the response type from the response
+    valid_types = ["PANIC", "GRIEF", "HIGH_DISTRESS", "NORMAL"]
+    for resp_type in valid_types:
+        if resp_type in assessment:
+            return resp_type.lower()
+    return None
 
-def generate_reply(
+
+def assess_response_type(
     user_text: str,
     emotions: List[Dict[str, float]],
-    preferences: Dict,
-    history: Optional[List[Dict]] = None,
-    summary: Optional[str] = None,
-    memory: Optional[Dict[str, Any]] = None,
+    emotion_profile: Optional[Tuple[str, str, bool]] = None,
+    keyword_scan: Optional[Tuple[frozenset, Optional[Tuple[str, str]]]] = None,
 ) -> str:
-    user_lower = (user_text or "").lower()
-    history = history or []
-
-    # STEP 1: Use Gemini to assess response type, considering RoBERTa emotions
-    response_type = assess_response_type(user_text, emotions)
-    logger.info(f"Response type determined: {response_type}")
-
-    # Extract tone preference
-    tone = preferences.get('tone', 'empathetic').lower(
-    ) if preferences else 'empathetic'
-
-    # Define tone styles for mental health context
-    tone_styles = {
-        'empathetic': {
-            'style': 'warm, deeply understanding, and compassionate',
-            'approach': 'Validate feelings gently and offer comforting presence'
-        },
-        'supportive': {
-            'style': 'encouraging, uplifting, and positive',
-            'approach': 'Focus on strengths and offer hopeful perspectives'
-        },
-        'professional': {
-            'style': 'respectful, structured, and therapeutic',
-            'approach': 'Use therapeutic language while maintaining warmth'
-        },
-        'gentle': {
-            'style': 'soft, calming, and tender',
-            'approach': 'Speak very softly and prioritize comfort over all else'
-        },
-        'casual': {
-            'style': 'friendly, relaxed, and conversational',
-            'approach': 'Chat like a close friend who genuinely cares'
-        },
-        'batman': {
-            'style': 'gravelly, direct, and justice-oriented with dark knight wisdom',
-            'approach': 'Speak like batman. Speak with intensity and determination, emphasizing strength and resilience. Use short, powerful statements. Channel the darkness into hope.'
-        }
-    }
-
-    tone_config = tone_styles.get(tone, tone_styles['empathetic'])
+    """
+    Use Gemini to intelligently determine response type, considering RoBERTa emotions.
+    Returns response type: immediate_danger, grief, panic, high_distress, or normal
+    emotion_profile is _summarize_emotions(emotions) and keyword_scan is
+    _scan_message(user_text.lower()); each is computed here if not supplied.
 
-    # Get recent conversation context
-    recent_history = history[-12:]
-    convo_snippets = [
-        f"{'You' if h.get('role') == 'user' else 'Me'}: {h.get('text', '').strip()}"
-        for h in recent_history if h.get('text', '').strip()
-    ]
-    convo_context = "\n".join(
-        convo_snippets) if convo_snippets else "Just getting our convo going!"
-    main_emotions = [e.get('label', '')
-                     for e in emotions[:3] if e.get('score', 0) > 0.3]
-    emotion_context = ", ".join(
-        main_emotions) if main_emotions else "just feeling regular"
-    memory = memory or {}
-    main_focus = memory.get("stressor") or memory.get(
-        "motivation") or "whatever's up right now"
-    helpful_things = memory.get("coping", [])
-    helpful_things_str = ', '.join(
-        helpful_things[:2]) if helpful_things else "just finding what works and what doesn't"
+    STEP 1: Check for explicit crisis keywords first (safety-first approach)
+    STEP 2: Use Gemini for nuanced assessment if not clearly a crisis
+    """
+    # ============ STEP 1: EXPLICIT CRISIS KEYWORD CHECK ============
+    # This catches obvious self-harm/suicide mentions BEFORE Gemini
+    # to prevent over-interpretation of user intent
 
-    # STEP 2: Handle each response type appropriately
+    # Check for explicit markers (the same scan tags grief and escalation words)
+    keyword_tags, crisis_marker = keyword_scan or _scan_message(user_text.lower())
+    if crisis_marker:
+        category, marker = crisis_marker
+        logger.warning(f"🚨 EXPLICIT CRISIS MARKER DETECTED ({category}): '{marker}' in message")
+        return "immediate_danger"
 
-    # IMMEDIATE_DANGER: User may be in crisis
-    if response_type == "immediate_danger":
-        logger.warning(f"🚨 CRISIS DETECTED - Message: {user_text[:100]}")
+    # ============ STEP 2: EMOTION-BASED CHECK ============
+    # Top RoBERTa emotion, read once and reused by the grief check and both fallbacks
+    top_emotion = emotions[0].get('label', '').lower() if emotions else ''
+    top_score = emotions[0].get('score', 0) if emotions else 0
 
-        crisis_resources_text = "**🆘 IMMEDIATE HELP - PHILIPPINES CRISIS HOTLINES:**\n\n"
-        for hotline in PHILIPPINE_CRISIS_RESOURCES["national_hotlines"]:
-            crisis_resources_text += f"• {hotline}\n"
-        crisis_resources_text += f"\n• {PHILIPPINE_CRISIS_RESOURCES['emergency']}\n\n"
-        crisis_resources_text += "**Regional Support:**\n"
-        for hotline in PHILIPPINE_CRISIS_RESOURCES["regional_hotlines"]:
-            crisis_resources_text += f"• {hotline}\n"
-        crisis_resources_text += "\n**These are all FREE, confidential, and available 24/7.**"
+    # If high sadness + specific loss keywords = GRIEF (not crisis)
+    if top_emotion:
+        # Grief detection - specific loss language
+        if top_emotion == 'sadness' and top_score > 0.7 and "grief" in keyword_tags:
+            logger.info(f"Response type: GRIEF (sadness + loss keywords)")
+            return "grief"
 
-        crisis_prompt = f'''You are Enoki, a compassionate mental health companion. The user expressed concerns about self-harm or suicide.
+    # Extract emotion context from RoBERTa
+    emotion_summary, _, distressed = emotion_profile or _summarize_emotions(emotions)
 
-Recent conversation:
+    # ============ STEP 3: GEMINI ASSESSMENT FOR EDGE CASES ============
+    # Only use Gemini for nuanced assessment if no explicit markers found
+    # This prevents over-interpretation while catching subtle crises
+    # Only bare greetings and acknowledgements skip the call and use the emotion fallback
+    # Collapsed whitespace doubles as the classification cache key, so "im  fine\n" and
+    # "im fine" share one entry
+    stripped_text = " ".join(user_text.split())
+    if _needs_assessment(stripped_text, "escalation" in keyword_tags, distressed, top_score):
+        try:
+            assessment = _classify_with_gemini(stripped_text, emotion_summary)
+            if assessment:
+                return assessment
+        except Exception as e:
+            _log_gemini_failure("Response type assessment", e)
+            # Fallback: Use RoBERTa emotions to make a safe guess
+            if top_score > 0.6:
+                if top_emotion == 'fear':
+                    logger.info(f"Exception fallback to panic based on {top_emotion}")
+                    return "panic"
+                elif top_emotion in ['sadness', 'anger']:
+                    logger.info(f"Exception fallback to high_distress based on {top_emotion}")
+                    return "high_distress"
+            return "normal"
+
+    # Fallback: If Gemini doesn't classify clearly, use emotions
+    if top_score > 0.7:
+        if top_emotion == 'fear':
+            logger.info(f"Fallback to panic based on high fear emotion")
+            return "panic"
+        elif top_emotion == 'sadness':
+            logger.info(f"Fallback to high_distress based on high sadness emotion")
+            return "high_distress"
+
+    return "normal"
+
+
+# Define tone styles for mental health context (read-only, shared by every request)
+TONE_STYLES = MappingProxyType({
+    'empathetic': MappingProxyType({
+        'style': 'warm, deeply understanding, and compassionate',
+        'approach': 'Validate feelings gently and offer comforting presence'
+    }),
+    'supportive': MappingProxyType({
+        'style': 'encouraging, uplifting, and positive',
+        'approach': 'Focus on strengths and offer hopeful perspectives'
+    }),
+    'professional': MappingProxyType({
+        'style': 'respectful, structured, and therapeutic',
+        'approach': 'Use therapeutic language while maintaining warmth'
+    }),
+    'gentle': MappingProxyType({
+        'style': 'soft, calming, and tender',
+        'approach': 'Speak very softly and prioritize comfort over all else'
+    }),
+    'casual': MappingProxyType({
+        'style': 'friendly, relaxed, and conversational',
+        'approach': 'Chat like a close friend who genuinely cares'
+    }),
+    'batman': MappingProxyType({
+        'style': 'gravelly, direct, and justice-oriented with dark knight wisdom',
+        'approach': 'Speak like batman. Speak with intensity and determination, emphasizing strength and resilience. Use short, powerful statements. Channel the darkness into hope.'
+    }),
+})
+
+# Canned replies used when Gemini fails or returns nothing
+CRISIS_FALLBACK = f"I'm really concerned about you right now. Your life has value, and there are people who want to help you through this.\n\n{CRISIS_RESOURCES_TEXT}\n\nPlease reach out to one of these resources right now. You don't have to face this alone."
+GRIEF_FALLBACK = "I'm so sorry for your loss. The love you had is real and precious, and grief is the price we pay for that love. I'm here with you through this."
+PANIC_FALLBACK = "You're not alone. I'm here with you. Breathe in slowly—1, 2, 3, 4. Hold—1, 2, 3, 4. Out—1, 2, 3, 4.\n\nYou're safe. This will pass."
+DISTRESS_FALLBACK = "I hear you, and I'm here for you. What you're feeling is real and valid. I'm listening."
+NORMAL_FALLBACKS = (
+    "Hey, sorry if my reply's a bit off—my brain might be on autopilot! What's up with you today?",
+    "Haha, sometimes I just space out. Want to share what's on your mind?",
+)
+
+# Prompt budget for recent conversation context
+CONTEXT_MAX_MESSAGES = 12
+CONTEXT_BUDGET_CHARS = 1500
+CONTEXT_MESSAGE_CHARS = 200
+# Same idea for the summary prompt, which only needs the gist of each turn
+SUMMARY_MAX_MESSAGES = 6
+SUMMARY_BUDGET_CHARS = 600
+SUMMARY_MESSAGE_CHARS = 100
+SUMMARY_LATEST_CHARS = 500
+
+
+def _clip(text: str, limit: int) -> str:
+    return text[:limit] + "..." if len(text) > limit else text
+
+
+def _recent_snippets(
+    history: List[Dict],
+    max_messages: int = CONTEXT_MAX_MESSAGES,
+    message_chars: int = CONTEXT_MESSAGE_CHARS,
+    budget_chars: int = CONTEXT_BUDGET_CHARS,
+    speakers: Tuple[str, str] = ("You", "Me"),
+) -> List[str]:
+    """
+    Format the recent turns for a prompt, newest kept first.
+    Each message is cut to message_chars and the oldest turns are
+    dropped once budget_chars is reached.
+    """
+    snippets = []
+    used = 0
+    recent = history[-max_messages:]
+    for index, h in enumerate(reversed(recent)):
+        text = h.get('text', '').strip()
+        if not text:
+            continue
+        speaker = speakers[0] if h.get('role') == 'user' else speakers[1]
+        snippet = f"{speaker}: {_clip(text, message_chars)}"
+        if used + len(snippet) > budget_chars:
+            logger.info(f"Prompt context trimmed to {budget_chars} chars: "
+                        f"dropped {len(recent) - index} older messages")
+            break
+        snippets.append(snippet)
+        used += len(snippet) + 1
+    snippets.reverse()
+    return snippets
+
+
+# Prompt template for each response type; str.format fields are filled per turn
+
+# Context block and hotline rules shared by the branch templates below
+PROMPT_CONTEXT = '''Recent conversation:
 {convo_context}
 
 Current message: "{user_text}"
 
-Emotional indicators (RoBERTa): {emotion_context}
-
-**CRITICAL INSTRUCTIONS - HOTLINE HANDLING**:
+Emotional indicators (RoBERTa): {emotion_context}'''
+HOTLINE_RULES = '''**CRITICAL INSTRUCTIONS - HOTLINE HANDLING**:
 - WHENEVER you give hotlines/resources, ONLY use the ones PROVIDED BELOW
 - DO NOT suggest any other hotlines from your training knowledge
 - DO NOT add, mention, or recommend any hotlines that are not explicitly listed below
 - Repeat back EXACTLY the hotlines I gave you - no alternatives
-- If user asks for hotlines, give ONLY these specific numbers
-
-**CRITICAL INSTRUCTIONS**:
+- If user asks for hotlines, give ONLY these specific numbers'''
+
+# IMMEDIATE_DANGER: User may be in crisis
+CRISIS_PROMPT = "\n\n".join([
+    'You are Enoki, a compassionate mental health companion. The user expressed concerns about self-harm or suicide.',
+    PROMPT_CONTEXT,
+    HOTLINE_RULES,
+    '''**CRITICAL INSTRUCTIONS**:
 - DO NOT repeat or echo back what they said
 - DO NOT start with casual interjections like "Hey!" or "Oh!"
 - DO take this seriously and respond with genuine concern
-- Style: {tone_config['style']}
-- Approach: {tone_config['approach']}
+- Style: {tone_style}
+- Approach: {tone_approach}
 
 **Your task** (be concise and complete):
 1. Validate their feelings with genuine concern
@@ -340,48 +651,21 @@ Emotional indicators (RoBERTa): {emotion_context}
 **Response length**: This is a crisis - respond with appropriate depth and care. Be thorough but not verbose. Use length that matches severity.
 
 Crisis Resources (ONLY these resources - do not add others):
-{crisis_resources_text}
-
-Keep it warm, caring, and complete - no cut-off sentences. Reference their situation from the conversation.'''
-
-        try:
-            response = model.generate_content(
-                crisis_prompt,
-                generation_config={
-                    "temperature": 0.7,
-                    "max_output_tokens": 1000
-                },
-                request_options={"timeout": 10}
-            )
-            reply = safe_get_response_text(response)
-            if reply:
-                return add_breaks(reply)
-            else:
-                raise Exception("Empty response from Gemini")
-        except Exception as e:
-            logger.error(f"Crisis response generation failed: {str(e)}")
-            fallback_msg = f"I'm really concerned about you right now. Your life has value, and there are people who want to help you through this.\n\n{crisis_resources_text}\n\nPlease reach out to one of these resources right now. You don't have to face this alone."
-            return add_breaks(fallback_msg)
-
-    # GRIEF: User is processing loss
-    elif response_type == "grief":
-        logger.info(f"Grief support needed")
-
-        grief_prompt = f'''You are Enoki, supporting someone experiencing grief and loss.
-
-Recent conversation:
-{convo_context}
-
-Current message: "{user_text}"
+{crisis_resources}
 
-Emotional indicators (RoBERTa): {emotion_context}
+Keep it warm, caring, and complete - no cut-off sentences. Reference their situation from the conversation.''',
+])
 
-**CRITICAL INSTRUCTIONS**:
+# GRIEF: User is processing loss
+GRIEF_PROMPT = "\n\n".join([
+    'You are Enoki, supporting someone experiencing grief and loss.',
+    PROMPT_CONTEXT,
+    '''**CRITICAL INSTRUCTIONS**:
 - DO NOT repeat or echo back what they said
 - DO NOT start with "Hey!" or similar casual greetings
 - DO respond with deep compassion
-- Style: {tone_config['style']}
-- Approach: {tone_config['approach']}
+- Style: {tone_style}
+- Approach: {tone_approach}
 
 **Your task** (be concise and complete):
 1. Respond with deep compassion and understanding
@@ -392,46 +676,19 @@ Emotional indicators (RoBERTa): {emotion_context}
 
 **Response length**: Grief requires thoughtful, unhurried response. Match the depth of their loss. Be thorough - don't rush.
 
-Keep it warm, gentle, and complete - no cut-off sentences. Reference their loss and our conversation history.'''
-
-        try:
-            response = model.generate_content(
-                grief_prompt,
-                generation_config={
-                    "temperature": 0.7,
-                    "max_output_tokens": 600
-                },
-                request_options={"timeout": 10}
-            )
-            grief_reply = safe_get_response_text(response)
-            if grief_reply:
-                return add_breaks(grief_reply)
-            else:
-                raise Exception("Empty response from Gemini")
-        except Exception as e:
-            logger.error(f"Grief response generation failed: {str(e)}")
-            fallback_grief = f"I'm so sorry for your loss. The love you had is real and precious, and grief is the price we pay for that love. I'm here with you through this."
-            return add_breaks(fallback_grief)
-
-    # PANIC: User is having a panic attack or acute anxiety
-    elif response_type == "panic":
-        logger.info(f"Panic attack support needed")
+Keep it warm, gentle, and complete - no cut-off sentences. Reference their loss and our conversation history.''',
+])
 
-        panic_prompt = f'''You are Enoki, supporting someone experiencing a panic attack or acute anxiety.
-
-Recent conversation:
-{convo_context}
-
-Current message: "{user_text}"
-
-Emotional indicators (RoBERTa): {emotion_context}
-
-**CRITICAL INSTRUCTIONS**:
+# PANIC: User is having a panic attack or acute anxiety
+PANIC_PROMPT = "\n\n".join([
+    'You are Enoki, supporting someone experiencing a panic attack or acute anxiety.',
+    PROMPT_CONTEXT,
+    '''**CRITICAL INSTRUCTIONS**:
 - DO NOT repeat or echo back what they said
 - DO NOT start with "Hey!" or casual greetings
 - DO provide immediate grounding support
-- Style: {tone_config['style']}
-- Approach: {tone_config['approach']}
+- Style: {tone_style}
+- Approach: {tone_approach}
 
 **Your task** (be concise and complete):
 1. Respond with immediate grounding and support
@@ -442,106 +699,39 @@ Emotional indicators (RoBERTa): {emotion_context}
 
 **Response length**: Panic needs focused, direct support. Be concise but thorough - help them ground NOW. Don't ramble.
 
-Keep it warm, calming, and complete - no cut-off sentences. Reference their situation from our conversation.'''
-
-        try:
-            response = model.generate_content(
-                panic_prompt,
-                generation_config={
-                    "temperature": 0.7,
-                    "max_output_tokens": 600
-                },
-                request_options={"timeout": 10}
-            )
-            panic_reply = safe_get_response_text(response)
-            if panic_reply:
-                return add_breaks(panic_reply)
-            else:
-                raise Exception("Empty response from Gemini")
-        except Exception as e:
-            logger.error(f"Panic response generation failed: {str(e)}")
-            fallback_panic = f"You're not alone. I'm here with you. Breathe in slowly—1, 2, 3, 4. Hold—1, 2, 3, 4. Out—1, 2, 3, 4.\n\nYou're safe. This will pass."
-            return add_breaks(fallback_panic)
-
-    # HIGH_DISTRESS: User expresses severe emotional distress
-    elif response_type == "high_distress":
-        logger.info(f"High distress support needed")
-
-        crisis_resources = "\n".join(
-            PHILIPPINE_CRISIS_RESOURCES["national_hotlines"])
-        emergency = PHILIPPINE_CRISIS_RESOURCES["emergency"]
-
-        distress_prompt = f'''You are Enoki, supporting someone in emotional distress.
-
-Recent conversation:
-{convo_context}
-
-Current message: "{user_text}"
+Keep it warm, calming, and complete - no cut-off sentences. Reference their situation from our conversation.''',
+])
 
-Emotional indicators (RoBERTa): {emotion_context}
-Their situation: {main_focus}
-
-**CRITICAL INSTRUCTIONS - HOTLINE HANDLING**:
-- WHENEVER you give hotlines/resources, ONLY use the ones PROVIDED BELOW
-- DO NOT suggest any other hotlines from your training knowledge
-- DO NOT add, mention, or recommend any hotlines that are not explicitly listed below
-- Repeat back EXACTLY the hotlines I gave you - no alternatives
-- If user asks for hotlines, give ONLY these specific numbers
-
-**CRITICAL INSTRUCTIONS**:
+# HIGH_DISTRESS: User expresses severe emotional distress
+DISTRESS_PROMPT = "\n\n".join([
+    'You are Enoki, supporting someone in emotional distress.',
+    PROMPT_CONTEXT + "\nTheir situation: {main_focus}",
+    HOTLINE_RULES,
+    '''**CRITICAL INSTRUCTIONS**:
 - DO NOT repeat or echo back what they said
 - DO NOT start with "Hey!" or casual greetings
 - DO respond with genuine concern
-- Style: {tone_config['style']}
-- Approach: {tone_config['approach']}
+- Style: {tone_style}
+- Approach: {tone_approach}
 
 **Your task** (be concise and complete):
 1. Validate their feelings with genuine understanding
 2. Show you take this seriously
 3. Offer 2-3 practical, actionable suggestions (be specific)
 4. If they mention suicide/self-harm, include these resources:
-{crisis_resources}
-{emergency}
+{distress_resources}
 5. End with hope and reassurance
 
 **Response length**: Match the depth of their distress. If severe, be thorough. If manageable, be brief but supportive. Quality over quantity.
 
-**Tone**: {tone_config['style']}
+Keep it warm, caring, and concise. Complete your thoughts - no cut-off sentences. Reference what they've shared with you.''',
+])
 
-Keep it warm, caring, and concise. Complete your thoughts - no cut-off sentences. Reference what they've shared with you.'''
-
-        try:
-            response = model.generate_content(
-                distress_prompt,
-                generation_config={
-                    "temperature": 0.7,
-                    "max_output_tokens": 700
-                },
-                request_options={"timeout": 10}
-            )
-            distress_reply = safe_get_response_text(response)
-            if distress_reply:
-                return add_breaks(distress_reply)
-            else:
-                raise Exception("Empty response from Gemini")
-        except Exception as e:
-            logger.error(f"High distress response generation failed: {str(e)}")
-            return add_breaks("I hear you, and I'm here for you. What you're feeling is real and valid. I'm listening.")
-
-    # NORMAL: Regular conversation
-    else:  # response_type == "normal"
-        normal_prompt = f'''You are Enoki, chatting like a close friend who genuinely cares.
-
-Recent conversation:
-{convo_context}
-
-Current message: "{user_text}"
-
-Emotional indicators (RoBERTa): {emotion_context}
-Their situation: {main_focus}
-What's helping them: {helpful_things_str}
-
-**CRITICAL INSTRUCTIONS - HOTLINE HANDLING**:
+# NORMAL: Regular conversation
+NORMAL_PROMPT = "\n\n".join([
+    'You are Enoki, chatting like a close friend who genuinely cares.',
+    PROMPT_CONTEXT + "\nTheir situation: {main_focus}\nWhat's helping them: {helpful_things}",
+    '''**CRITICAL INSTRUCTIONS - HOTLINE HANDLING**:
 - If user asks for hotlines/resources, ONLY provide these Philippines hotlines:
   • National Center for Mental Health Crisis Hotline: 1553 (landline nationwide, toll-free) or 0917-899-8727
   • HOPELINE Philippines: 2919 (Globe/TM toll-free) or (02) 8804-4673
@@ -552,7 +742,7 @@ What's helping them: {helpful_things_str}
 **CRITICAL INSTRUCTIONS**:
 - DO NOT repeat or echo back what they said
 - DO NOT start with "Hey!" or "Oh!" or similar interjections
-- DO match the tone: Style: {tone_config['style']} | Approach: {tone_config['approach']}
+- DO match the tone: Style: {tone_style} | Approach: {tone_approach}
 - DO respond conversationally as a friend would
 - DO be concise and genuine
 
@@ -565,46 +755,241 @@ What's helping them: {helpful_things_str}
 
 **Response length**: Keep it natural. Short and sweet for casual chat, longer if they need advice. Don't force length - be genuine and conversational.
 
-Keep it natural, warm, and complete - no cut-off sentences. Remember what they've shared with you in our conversation.'''
+Keep it natural, warm, and complete - no cut-off sentences. Remember what they've shared with you in our conversation.''',
+])
 
-        try:
-            response = model.generate_content(
-                normal_prompt,
-                generation_config={
-                    "temperature": 0.7,
-                    "max_output_tokens": 600
-                },
-                request_options={"timeout": 10}
-            )
+# response_type -> (prompt template, generation config, fallback replies)
+REPLY_BRANCHES = {
+    "immediate_danger": (CRISIS_PROMPT, CRISIS_GENERATION_CONFIG, (CRISIS_FALLBACK,)),
+    "grief": (GRIEF_PROMPT, REPLY_GENERATION_CONFIG, (GRIEF_FALLBACK,)),
+    "panic": (PANIC_PROMPT, REPLY_GENERATION_CONFIG, (PANIC_FALLBACK,)),
+    "high_distress": (DISTRESS_PROMPT, DISTRESS_GENERATION_CONFIG, (DISTRESS_FALLBACK,)),
+    "normal": (NORMAL_PROMPT, REPLY_GENERATION_CONFIG, NORMAL_FALLBACKS),
+}
+
+
+def _prompt_fields(
+    user_text: str,
+    preferences: Dict,
+    history: Optional[List[Dict]],
+    memory: Optional[Dict[str, Any]],
+    emotion_profile: Tuple[str, str, bool],
+) -> Dict[str, str]:
+    """The per-turn str.format fields shared by every REPLY_BRANCHES template."""
+    # Extract tone preference
+    tone = preferences.get('tone', 'empathetic').lower(
+    ) if preferences else 'empathetic'
+
+    tone_config = TONE_STYLES.get(tone, TONE_STYLES['empathetic'])
+
+    # Get recent conversation context
+    convo_snippets = _recent_snippets(history or [])
+    convo_context = "\n".join(
+        convo_snippets) if convo_snippets else "Just getting our convo going!"
+    memory = memory or {}
+    main_focus = memory.get("stressor") or memory.get(
+        "motivation") or "whatever's up right now"
+    helpful_things = memory.get("coping", [])
+    helpful_things_str = ', '.join(
+        helpful_things[:2]) if helpful_things else "just finding what works and what doesn't"
+
+    return {
+        "convo_context": convo_context,
+        "user_text": user_text,
+        "emotion_context": emotion_profile[1],
+        "main_focus": main_focus,
+        "helpful_things": helpful_things_str,
+        "tone_style": tone_config['style'],
+        "tone_approach": tone_config['approach'],
+        "crisis_resources": CRISIS_RESOURCES_TEXT,
+        "distress_resources": DISTRESS_RESOURCES_TEXT,
+    }
+
+
+def _fill_reply(response_type: str, fields: Dict[str, str]) -> Tuple[str, str, Dict[str, Any], str]:
+    """Fill the branch's prompt template: (response_type, prompt, generation_config, fallback_text)."""
+    if response_type == "immediate_danger":
+        logger.warning(f"🚨 CRISIS DETECTED - Message: {fields['user_text'][:100]}")
+    elif response_type != "normal":
+        logger.info(f"{response_type} support needed")
+
+    template, generation_config, fallbacks = REPLY_BRANCHES.get(response_type, REPLY_BRANCHES["normal"])
+    return response_type, template.format(**fields), generation_config, random.choice(fallbacks)
+
+
+def _prepare_reply(
+    user_text: str,
+    emotions: List[Dict[str, float]],
+    preferences: Dict,
+    history: Optional[List[Dict]] = None,
+    memory: Optional[Dict[str, Any]] = None,
+    response_type: Optional[str] = None,
+    emotion_profile: Optional[Tuple[str, str, bool]] = None,
+) -> Tuple[str, str, Dict[str, Any], str]:
+    """
+    Assess the turn (unless response_type is given) and build the branch-specific prompt.
+    Returns (response_type, prompt, generation_config, fallback_text).
+    """
+    # STEP 1: Use Gemini to assess response type, considering RoBERTa emotions
+    emotion_profile = emotion_profile or _summarize_emotions(emotions)
+    if response_type is None:
+        response_type = assess_response_type(user_text, emotions, emotion_profile)
+        logger.info(f"Response type determined: {response_type}")
+
+    # STEP 2: Fill in the branch's prompt template
+    fields = _prompt_fields(user_text, preferences, history, memory, emotion_profile)
+    return _fill_reply(response_type, fields)
+
+
+def _request_reply(prompt: str, generation_config: Dict[str, Any], stream: bool = False):
+    return model.generate_content(
+        prompt,
+        generation_config=generation_config,
+        request_options=STREAM_REQUEST_OPTIONS if stream else REQUEST_OPTIONS,
+        stream=stream
+    )
+
+
+def _prepare_speculative_reply(
+    user_text: str,
+    emotions: List[Dict[str, float]],
+    preferences: Dict,
+    history: Optional[List[Dict]],
+    memory: Optional[Dict[str, Any]],
+    stream: bool = False,
+) -> Tuple[str, str, Dict[str, Any], str, Optional[Future]]:
+    """
+    _prepare_reply, but the normal-branch reply request is sent while the turn is being
+    classified. Most turns are normal, so the classification round-trip overlaps the reply.
+    Returns _prepare_reply's tuple plus the in-flight request future when the turn is
+    normal (None otherwise; the speculative reply is then discarded, never shown).
+    """
+    emotion_profile = _summarize_emotions(emotions)
+    # Lowercase and scan the message once; assess_response_type reuses the result
+    keyword_scan = _scan_message(user_text.lower())
+    # Explicit crisis markers are decided locally; don't spend a request on those turns
+    if keyword_scan[1]:
+        response_type = assess_response_type(user_text, emotions, emotion_profile, keyword_scan)
+        return (*_prepare_reply(user_text, emotions, preferences, history, memory,
+                                response_type=response_type, emotion_profile=emotion_profile), None)
+
+    # Context, memory and tone are rendered once and shared by both candidate branches
+    fields = _prompt_fields(user_text, preferences, history, memory, emotion_profile)
+    _, normal_prompt, normal_config, normal_fallback = _fill_reply("normal", fields)
+    pending = _gemini_executor.submit(_request_reply, normal_prompt, normal_config, stream)
+
+    response_type = assess_response_type(user_text, emotions, emotion_profile, keyword_scan)
+    logger.info(f"Response type determined: {response_type}")
+    if response_type == "normal":
+        return response_type, normal_prompt, normal_config, normal_fallback, pending
+
+    if pending:
+        pending.cancel()
+    return (*_fill_reply(response_type, fields), None)
+
+
+def _start_reply(response_type: str, prompt: str, generation_config: Dict[str, Any],
+                 pending: Optional[Future], stream: bool = False):
+    """
+    The Gemini response for a prepared turn: the speculative request if there is one,
+    otherwise a fresh request. Crisis turns are always requested as a stream and must
+    deliver their first chunk within CRISIS_REPLY_DEADLINE; on timeout this raises and
+    the caller sends CRISIS_FALLBACK, which has the hotlines.
+    """
+    if pending:
+        return pending.result()
+    if response_type != "immediate_danger":
+        return _request_reply(prompt, generation_config, stream)
+
+    # Opening the stream returns once the first chunk has arrived
+    crisis = _gemini_executor.submit(_request_reply, prompt, generation_config, True)
+    try:
+        return crisis.result(timeout=CRISIS_REPLY_DEADLINE)
+    except TimeoutError:
+        crisis.cancel()
+        raise TimeoutError(f"no crisis reply chunk within {CRISIS_REPLY_DEADLINE}s")
+
+
+def _log_usage(response_type: str, response) -> None:
+    """Log the token counts of a finished reply, to size each branch's max_output_tokens."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        logger.info(f"{response_type} reply tokens: prompt={usage.prompt_token_count}, "
+                    f"output={usage.candidates_token_count}")
+
+
+def generate_reply(
+    user_text: str,
+    emotions: List[Dict[str, float]],
+    preferences: Dict,
+    history: Optional[List[Dict]] = None,
+    summary: Optional[str] = None,
+    memory: Optional[Dict[str, Any]] = None,
+) -> str:
+    response_type, prompt, generation_config, fallback, pending = _prepare_speculative_reply(
+        user_text, emotions, preferences, history, memory)
+
+    try:
+        response = _start_reply(response_type, prompt, generation_config, pending)
+        if response_type == "immediate_danger":
+            # Crisis replies arrive streamed (see _start_reply); collect the rest here
+            reply = "".join(iter_response_text(response)).strip()
+        else:
             reply = safe_get_response_text(response)
-            if reply:
-                return add_breaks(reply)
-            else:
-                raise Exception("Empty response from Gemini")
-        except Exception as e:
-            logger.error(f"Normal response generation failed: {str(e)}")
-            return add_breaks(
-                random.choice([
-                    "Hey, sorry if my reply's a bit off—my brain might be on autopilot! What's up with you today?",
-                    "Haha, sometimes I just space out. Want to share what's on your mind?"
-                ])
-            )
+        _log_usage(response_type, response)
+        if reply:
+            return add_breaks(reply)
+        else:
+            raise Exception("Empty response from Gemini")
+    except Exception as e:
+        _log_gemini_failure(f"{response_type} response generation", e)
+        return add_breaks(fallback)
+
+
+def stream_reply(
+    user_text: str,
+    emotions: List[Dict[str, float]],
+    preferences: Dict,
+    history: Optional[List[Dict]] = None,
+    summary: Optional[str] = None,
+    memory: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    Streaming variant of generate_reply: yields each sentence as soon as Gemini has
+    produced them. Joining everything yielded gives the same text generate_reply returns.
+    """
+    response_type, prompt, generation_config, fallback, pending = _prepare_speculative_reply(
+        user_text, emotions, preferences, history, memory, stream=True)
+
+    pieces = []
+    try:
+        response = _start_reply(response_type, prompt, generation_config, pending, stream=True)
+        for piece in stream_sentences(iter_response_text(response)):
+            pieces.append(piece)
+            yield piece
+        _log_usage(response_type, response)
+    except Exception as e:
+        _log_gemini_failure(f"{response_type} response streaming", e)
+
+    if not pieces:
+        yield add_breaks(fallback)
 
 
 def update_summary(existing_summary: Optional[str], history: List[Dict], latest_user: str, latest_bot: str) -> str:
-    recent_snips = []
-    for entry in history[-6:]:
-        speaker = "They" if entry['role'] == 'user' else "I"
-        text_cut = entry['text'][:100] + \
-            ("..." if len(entry['text']) > 100 else "")
-        recent_snips.append(f"{speaker}: {text_cut}")
+    recent_snips = _recent_snippets(
+        history,
+        max_messages=SUMMARY_MAX_MESSAGES,
+        message_chars=SUMMARY_MESSAGE_CHARS,
+        budget_chars=SUMMARY_BUDGET_CHARS,
+        speakers=("They", "I"),
+    )
     recent_context = "\n".join(recent_snips)
     prompt = f"""Here's what we've talked about recently:
 
 {recent_context}
 
-They just said: {latest_user}
-I replied: {latest_bot}
+They just said: {_clip(latest_user, SUMMARY_LATEST_CHARS)}
+I replied: {_clip(latest_bot, SUMMARY_LATEST_CHARS)}
 
 Summarize naturally, under 100 words, including:
 - What they're going through
@@ -614,10 +999,11 @@ Summarize naturally, under 100 words, including:
 
 Keep it casual and friendly."""
     try:
-        result = model.generate_content(prompt)
+        result = model.generate_content(prompt, request_options=SUMMARY_REQUEST_OPTIONS)
         output = result.text.strip() if result.text else (existing_summary or "")
         return add_breaks(output)
-    except:
+    except Exception as e:
+        _log_gemini_failure("Summary update", e)
         return add_breaks(existing_summary or "Chat is ongoing and supportive.")
 
 
@@ -638,39 +1024,71 @@ COPING_MAP = {
     "meditation": "meditation",
     "exercise": "exercise"
 }
+COPING_TAGS = frozenset(COPING_MAP.values())
+
+# Keywords for each memory tag, scanned together in one pass. Category keywords match
+# at the start of a word (so "parents" counts but "apparently" does not); coping tags
+# are the COPING_MAP descriptions and only match whole words
+MEMORY_TAG_WORDS = {
+    "work": WORK_WORDS,
+    "school": SCHOOL_WORDS,
+    "family": FAMILY_WORDS,
+    "family_motivation": FAMILY_MOTIVATION,
+    "tuition": frozenset(["tuition"]),
+    "sibling": frozenset(["sister", "sibling"]),
+    "overwhelmed": FEELING_OVERWHELMED,
+    "better": FEELING_BETTER,
+    **{coping: [key] for key, coping in COPING_MAP.items()},
+}
+MEMORY_RE, MEMORY_WORD_TAGS = _keyword_index(
+    MEMORY_TAG_WORDS, whole_word_tags=COPING_TAGS, word_start_tags=MEMORY_TAG_WORDS)
+MEMORY_COPING_LIMIT = 8
+
+
+def _memory_tags(text_all: str) -> set:
+    """Every memory tag whose keywords occur anywhere in the text."""
+    tags = set()
+    for match in MEMORY_RE.finditer(text_all):
+        tags |= MEMORY_WORD_TAGS[match.group(1)]
+    return tags
 
 
 def update_memory(existing: Optional[Dict[str, Any]], history: List[Dict], latest_user: str, latest_bot: str) -> Dict[str, Any]:
     existing = existing or {}
+    slots_filled = all(existing.get(slot) for slot in ("stressor", "motivation", "trajectory"))
+    # Late in a session every slot is set and coping is at its cap, so nothing can change
+    if slots_filled and len(existing.get("coping", [])) >= MEMORY_COPING_LIMIT:
+        return existing
+
     recent_texts = [item['text'] for item in history[-8:] if item.get('text') and item.get('role') == 'user']
     recent_texts.append(latest_user)  # Only add user's latest message, not bot's
     text_all = " ".join(recent_texts).lower()
     
+    # Slots and coping habits all come from this single scan
+    tags = _memory_tags(text_all)
+
     if not existing.get("stressor"):
-        if any(w in text_all for w in WORK_WORDS):
+        if "work" in tags:
             existing["stressor"] = "work stress"
-        elif any(w in text_all for w in SCHOOL_WORDS):
+        elif "school" in tags:
             existing["stressor"] = "school stress"
-        elif any(w in text_all for w in FAMILY_WORDS):
+        elif "family" in tags:
             existing["stressor"] = "family stuff"
     
     if not existing.get("motivation"):
-        if "tuition" in text_all and ("sister" in text_all or "sibling" in text_all):
+        if "tuition" in tags and "sibling" in tags:
             existing["motivation"] = "helping family with school"
-        elif any(w in text_all for w in FAMILY_MOTIVATION):
+        elif "family_motivation" in tags:
             existing["motivation"] = "looking out for family"
     
     coping_set = set(existing.get("coping", []))
-    for key, val in COPING_MAP.items():
-        # Use word boundary matching to avoid false positives
-        if re.search(r'\b' + re.escape(key) + r'\b', text_all):
-            coping_set.add(val)
-    existing["coping"] = list(coping_set)[:8]
+    coping_set |= tags & COPING_TAGS
+    existing["coping"] = list(coping_set)[:MEMORY_COPING_LIMIT]
     
     if not existing.get("trajectory"):
-        if any(w in text_all for w in FEELING_OVERWHELMED):
+        if "overwhelmed" in tags:
             existing["trajectory"] = "feeling drained and overwhelmed"
-        elif any(w in text_all for w in FEELING_BETTER):
+        elif "better" in tags:
             existing["trajectory"] = "starting to feel better"
     
     return existing
\ No newline at end of file
@@ -1,19 +1,38 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from core.models import Message
 from core.security import encrypt_value, is_encrypted
 
+# Rows fetched per query while scanning, and rows written per UPDATE batch
+FETCH_CHUNK_SIZE = 2000
+UPDATE_BATCH_SIZE = 500
+
 
 class Command(BaseCommand):
     help = "Encrypt any stored Message.text values that are still plaintext. Requires ENCRYPTION_KEY."
 
     def handle(self, *args, **options):
-        total = 0
         updated = 0
-        for msg in Message.objects.all().only('id', 'text'):
-            total += 1
-            if msg.text and not is_encrypted(msg.text):
-                original = msg.text
-                msg.text = encrypt_value(original)
-                msg.save(update_fields=["text"])
-                updated += 1
-        self.stdout.write(self.style.SUCCESS(f"Scanned {total} messages. Encrypted {updated}."))
\ No newline at end of file
+        pending = []
+        with transaction.atomic():
+            # The indexed flag limits the scan to rows not yet known to be encrypted,
+            # so reruns only fetch the plaintext stragglers
+            candidates = (Message.objects.only('id', 'text', 'text_encrypted')
+                          .filter(text_encrypted=False)
+                          .exclude(text=""))
+            # Stream rows in chunks and write them back in batches instead of one UPDATE per row
+            for msg in candidates.iterator(chunk_size=FETCH_CHUNK_SIZE):
+                if not is_encrypted(msg.text):
+                    ciphertext = encrypt_value(msg.text)
+                    if ciphertext == msg.text:  # no ENCRYPTION_KEY configured
+                        continue
+                    msg.text = ciphertext
+                    updated += 1
+                msg.text_encrypted = True
+                pending.append(msg)
+                if len(pending) >= UPDATE_BATCH_SIZE:
+                    Message.objects.bulk_update(pending, ["text", "text_encrypted"])
+                    pending.clear()
+            if pending:
+                Message.objects.bulk_update(pending, ["text", "text_encrypted"])
+        self.stdout.write(self.style.SUCCESS(f"Encrypted {updated} plaintext messages."))
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+# Fernet token prefix, inlined so this migration never depends on app code
+ENCRYPTED_PREFIX = 'gAAAA'
+
+
+def mark_encrypted_rows(apps, schema_editor):
+    Message = apps.get_model('core', 'Message')
+    Message.objects.filter(text__startswith=ENCRYPTED_PREFIX).update(text_encrypted=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_add_consent_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='text_encrypted',
+            field=models.BooleanField(db_index=True, default=False, help_text='Whether text currently holds a Fernet token'),
+        ),
+        migrations.RunPython(mark_encrypted_rows, migrations.RunPython.noop),
+    ]
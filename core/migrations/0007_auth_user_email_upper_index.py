@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import migrations
+
+INDEX_NAME = 'auth_user_email_upper_idx'
+
+
+def _user_table(apps):
+    return apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+
+
+def create_email_index(apps, schema_editor):
+    # email__iexact compiles to UPPER(email) = UPPER(%s) on PostgreSQL, so index that expression.
+    # SQLite matches iexact with LIKE, which cannot use an expression index.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(_user_table(apps))
+    schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {table} (UPPER(email))')
+
+
+def drop_email_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0006_message_text_encrypted'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_email_index, drop_email_index),
+    ]
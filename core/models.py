@@ -63,6 +63,7 @@ class Message(models.Model):
 	session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name="messages")
 	sender = models.CharField(max_length=8, choices=SENDER_CHOICES)
 	text = models.TextField(help_text="Encrypted or plaintext depending on ENCRYPTION_KEY")
+	text_encrypted = models.BooleanField(default=False, db_index=True, help_text="Whether text currently holds a Fernet token")
 	emotions = models.JSONField(null=True, blank=True)  # list of {label, score}
 	created_at = models.DateTimeField(auto_now_add=True)
 
@@ -81,7 +82,21 @@ class Message(models.Model):
 
 	@property
 	def plaintext(self) -> str:
-		return decrypt_value(self.text)
+		# Reuse the last decryption while text is unchanged
+		cached = getattr(self, "_plaintext_cache", None)
+		if cached is not None and cached[0] is self.text:
+			return cached[1]
+		plain = decrypt_value(self.text)
+		self._plaintext_cache = (self.text, plain)
+		return plain
+
+	@classmethod
+	def bulk_decrypt(cls, messages):
+		"""Decrypt a batch of messages up front and return them as a list."""
+		messages = list(messages)
+		for m in messages:
+			m._plaintext_cache = (m.text, decrypt_value(m.text))
+		return messages
 
 	def set_plaintext(self, value: str):
 		self.text = encrypt_value(value)
@@ -89,7 +104,15 @@ class Message(models.Model):
 	def save(self, *args, **kwargs):
 		# Encrypt only if not already encrypted
 		if self.text and not is_encrypted(self.text):
-			self.text = encrypt_value(self.text)
+			plain = self.text
+			self.text = encrypt_value(plain)
+			# encrypt_value hands plaintext back when no ENCRYPTION_KEY is configured
+			self.text_encrypted = self.text != plain
+		else:
+			self.text_encrypted = bool(self.text)
+		update_fields = kwargs.get("update_fields")
+		if update_fields is not None and "text" in update_fields:
+			kwargs["update_fields"] = {*update_fields, "text_encrypted"}
 		super().save(*args, **kwargs)
 
 	def __str__(self):
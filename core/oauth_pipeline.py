@@ -39,18 +39,16 @@ def prevent_account_linking(strategy, backend, details, user=None, *args, **kwar
     else:
         # User is None - about to create new account
         # Check if email already belongs to a password account
-        try:
-            existing_user = User.objects.get(email=email)
-            if existing_user.has_usable_password():
-                # Email belongs to password account, block OAuth creation
-                raise AuthFailed(
-                    backend,
-                    'This email is already registered with a password. '
-                    'Please log in with your email and password instead.'
-                )
-        except User.DoesNotExist:
-            # Email is unique, safe to proceed
-            pass
+        # Only the password hash is needed, so skip loading the rest of the row;
+        # no match (or only OAuth accounts) means it is safe to proceed
+        existing_users = User.objects.only('id', 'password').filter(email__iexact=email)
+        if any(existing.has_usable_password() for existing in existing_users):
+            # Email belongs to password account, block OAuth creation
+            raise AuthFailed(
+                backend,
+                'This email is already registered with a password. '
+                'Please log in with your email and password instead.'
+            )
     
     # Validation passed, continue to next pipeline step (associate_user)
     return None
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import Optional
 
 try:
@@ -7,33 +8,31 @@ except ImportError:  # cryptography not installed yet
     Fernet = None  # type: ignore
     InvalidToken = Exception  # type: ignore
 
-_fernet: Optional[Fernet] = None
+# Fernet tokens are URL-safe base64 strings that start with this (version byte 0x80)
+ENCRYPTED_PREFIX = 'gAAAA'
 
 
-def _init_fernet():
-    global _fernet
-    if _fernet is not None:
-        return _fernet
+@lru_cache(maxsize=1)
+def _get_fernet() -> Optional[Fernet]:
+    # Resolved once per process, including the "no key configured" case
     key = os.getenv("ENCRYPTION_KEY")
     if not key or not Fernet:
-        _fernet = None
-    else:
-        try:
-            _fernet = Fernet(key.encode() if not key.startswith("gAAAA") else key)
-        except Exception:
-            _fernet = None
-    return _fernet
+        return None
+    try:
+        return Fernet(key.encode() if not key.startswith("gAAAA") else key)
+    except Exception:
+        return None
 
 
 def encrypt_value(plaintext: str) -> str:
-    f = _init_fernet()
+    f = _get_fernet()
     if not f or not plaintext:
         return plaintext
     return f.encrypt(plaintext.encode()).decode()
 
 
 def decrypt_value(token: str) -> str:
-    f = _init_fernet()
+    f = _get_fernet()
     if not f or not token:
         return token
     try:
@@ -45,11 +44,10 @@ def decrypt_value(token: str) -> str:
 
 
 def is_encrypted(value: str) -> bool:
-    f = _init_fernet()
+    f = _get_fernet()
     if not f or not value:
         return False
-    # Fernet tokens are URL-safe base64 strings that start with 'gAAAA'
-    if not value.startswith('gAAAA'):
+    if not value.startswith(ENCRYPTED_PREFIX):
         return False
     try:
         f.decrypt(value.encode())
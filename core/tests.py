@@ -0,0 +1,225 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+from core import gemini_client, views
+from core.models import ChatSession, Message
+
+REPLY_TEXT = ("That sounds like a lot. I'm here with you. What happened today? "
+              "Take your time. You can tell me as much or as little as you like. I'm listening.")
+NEUTRAL = [{"label": "neutral", "score": 0.9}]
+
+
+def fake_generate(prompt, generation_config=None, request_options=None, stream=False):
+    """Stand-in for GenerativeModel.generate_content; streams in uneven chunks."""
+    if not stream:
+        return SimpleNamespace(text=REPLY_TEXT, candidates=[])
+    return iter([SimpleNamespace(text=REPLY_TEXT[i:i + 11]) for i in range(0, len(REPLY_TEXT), 11)])
+
+
+def failing_generate(*args, **kwargs):
+    raise RuntimeError("Gemini unavailable")
+
+
+def patch_gemini(test, reply=fake_generate, classification="NORMAL"):
+    """Patch both Gemini models for the duration of a test."""
+    gemini_client._classify_cache.clear()
+    for target, kwargs in (
+        (gemini_client.model, {"side_effect": reply}),
+        (gemini_client.assessment_model, {"return_value": SimpleNamespace(text=classification)}),
+    ):
+        patcher = mock.patch.object(target, "generate_content", **kwargs)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class ResponseTypePrefilterTests(SimpleTestCase):
+    """Which messages skip the Gemini classification."""
+
+    def setUp(self):
+        gemini_client._classify_cache.clear()
+        patcher = mock.patch.object(
+            gemini_client.assessment_model, "generate_content",
+            return_value=SimpleNamespace(text="HIGH_DISTRESS"),
+        )
+        self.classify = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_passive_ideation_is_always_classified(self):
+        phrases = [
+            "I feel like a burden to everyone",
+            "nobody would notice if I disappeared",
+            "I can't go on like this",
+            "what's the point anymore",
+            "I don't want to be here anymore",
+            "i want to sleep forever",
+        ]
+        for emotions in ([], [{"label": "neutral", "score": 0.9}]):
+            for phrase in phrases:
+                with self.subTest(phrase=phrase, emotions=emotions):
+                    self.classify.reset_mock()
+                    gemini_client._classify_cache.clear()
+                    self.assertEqual(gemini_client.assess_response_type(phrase, emotions), "high_distress")
+                    self.classify.assert_called_once()
+
+    def test_bare_greeting_with_confident_emotions_skips_gemini(self):
+        result = gemini_client.assess_response_type("Hi!", [{"label": "neutral", "score": 0.9}])
+        self.assertEqual(result, "normal")
+        self.classify.assert_not_called()
+
+    def test_greeting_without_emotions_is_classified(self):
+        gemini_client.assess_response_type("Hi!", [])
+        self.classify.assert_called_once()
+
+    def test_short_message_with_distress_is_classified(self):
+        result = gemini_client.assess_response_type("panic!!", [{"label": "fear", "score": 0.65}])
+        self.assertEqual(result, "high_distress")
+        self.classify.assert_called_once()
+
+
+class ReplyStreamingTests(SimpleTestCase):
+    """stream_reply yields exactly what generate_reply returns."""
+
+    def test_stream_sentences_matches_add_breaks(self):
+        chunks = [REPLY_TEXT[i:i + 5] for i in range(0, len(REPLY_TEXT), 5)]
+        self.assertEqual("".join(gemini_client.stream_sentences(chunks)), gemini_client.add_breaks(REPLY_TEXT))
+
+    def test_streamed_and_non_streamed_replies_match(self):
+        patch_gemini(self)
+        reply = gemini_client.generate_reply("Work was rough today, long week", NEUTRAL, {"tone": "empathetic"})
+        streamed = "".join(gemini_client.stream_reply("Work was rough today, long week", NEUTRAL, {"tone": "empathetic"}))
+        self.assertEqual(reply, gemini_client.add_breaks(REPLY_TEXT))
+        self.assertEqual(streamed, reply)
+
+    def test_stream_falls_back_when_gemini_raises(self):
+        patch_gemini(self, reply=failing_generate)
+        streamed = "".join(gemini_client.stream_reply("Work was rough today, long week", NEUTRAL, {"tone": "empathetic"}))
+        self.assertIn(streamed, [gemini_client.add_breaks(text) for text in gemini_client.NORMAL_FALLBACKS])
+
+
+class CrisisReplyTests(SimpleTestCase):
+    """Explicit crisis markers skip classification and never wait long on Gemini."""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def slow_generate(self, *args, **kwargs):
+        self.release.wait(5)
+        return fake_generate(*args, **kwargs)
+
+    def test_crisis_marker_short_circuits_classification(self):
+        patch_gemini(self)
+        self.assertEqual(gemini_client.assess_response_type("I want to kill myself", NEUTRAL), "immediate_danger")
+        gemini_client.assessment_model.generate_content.assert_not_called()
+
+    def test_crisis_reply_uses_gemini_when_it_answers_in_time(self):
+        patch_gemini(self)
+        reply = gemini_client.generate_reply("I want to kill myself", NEUTRAL, {"tone": "empathetic"})
+        self.assertEqual(reply, gemini_client.add_breaks(REPLY_TEXT))
+
+    @mock.patch.object(gemini_client, "CRISIS_REPLY_DEADLINE", 0.05)
+    def test_slow_crisis_reply_falls_back_within_deadline(self):
+        patch_gemini(self, reply=self.slow_generate)
+        fallback = gemini_client.add_breaks(gemini_client.CRISIS_FALLBACK)
+        for reply_fn in (gemini_client.generate_reply,
+                         lambda *args: "".join(gemini_client.stream_reply(*args))):
+            started = time.monotonic()
+            reply = reply_fn("I want to kill myself", NEUTRAL, {"tone": "empathetic"})
+            self.assertLess(time.monotonic() - started, 1.0)
+            self.assertEqual(reply, fallback)
+
+
+class ChatStreamViewTests(TestCase):
+    """The SSE endpoint always finishes with a reply and a done event."""
+
+    def setUp(self):
+        patcher = mock.patch.object(views, "_classify_emotions", return_value=NEUTRAL)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stream_events(self, message):
+        response = self.client.post("/api/chat/stream/", data=json.dumps({"message": message}),
+                                    content_type="application/json")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join(response.streaming_content).decode()
+        return [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+
+    def test_streams_reply_deltas_then_done(self):
+        patch_gemini(self)
+        events = self.stream_events("Work was rough today, long week")
+        self.assertEqual("".join(e["delta"] for e in events if "delta" in e), gemini_client.add_breaks(REPLY_TEXT))
+        self.assertTrue(events[-1]["done"])
+
+    def test_sends_fallback_when_gemini_raises(self):
+        patch_gemini(self, reply=failing_generate)
+        events = self.stream_events("Work was rough today, long week")
+        reply = "".join(e["delta"] for e in events if "delta" in e)
+        self.assertIn(reply, [gemini_client.add_breaks(text) for text in gemini_client.NORMAL_FALLBACKS])
+        self.assertTrue(events[-1]["done"])
+
+
+class PersistTurnTests(TestCase):
+    """_persist_turn stores the turn and queues the summary refresh once it commits."""
+
+    def setUp(self):
+        self.user = User.objects.create_user("persist", password="pw12345!X")
+        self.session = ChatSession.objects.create(user=self.user)
+        self.request = RequestFactory().post("/api/chat/")
+        self.request.user = self.user
+
+    @mock.patch.object(views, "_summary_executor")
+    def test_writes_messages_memory_and_queues_summary(self, summary_executor):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            views._persist_turn(self.request, self.session, [], "my boss keeps adding shifts", NEUTRAL, "That sounds tiring.")
+
+        messages = list(self.session.messages.order_by("created_at"))
+        self.assertEqual([(m.sender, m.plaintext) for m in messages],
+                         [("user", "my boss keeps adding shifts"), ("bot", "That sounds tiring.")])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.memory["stressor"], "work stress")
+        self.assertEqual(len(callbacks), 1)
+        summary_executor.submit.assert_called_once_with(
+            views._refresh_summary, self.session.id,
+            [{"role": "user", "text": "my boss keeps adding shifts"}, {"role": "bot", "text": "That sounds tiring."}],
+            "my boss keeps adding shifts", "That sounds tiring.",
+        )
+
+    @mock.patch.object(views, "_summary_executor")
+    def test_summary_not_queued_if_the_turn_rolls_back(self, summary_executor):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with mock.patch.object(views, "update_memory", side_effect=RuntimeError("boom")):
+                with self.assertRaises(RuntimeError):
+                    views._persist_turn(self.request, self.session, [], "hello", NEUTRAL, "Hi!")
+        self.assertEqual(callbacks, [])
+        self.assertFalse(Message.objects.filter(session=self.session).exists())
+        summary_executor.submit.assert_not_called()
+
+
+class UpdateMemoryTests(SimpleTestCase):
+    """Keyword tags that feed the structured session memory."""
+
+    def memory_for(self, text):
+        return gemini_client.update_memory({}, [], text, "")
+
+    def test_category_keywords_set_slots(self):
+        memory = self.memory_for("My parents and my sister need help with tuition, I'm exhausted")
+        self.assertEqual(memory["stressor"], "family stuff")
+        self.assertEqual(memory["motivation"], "helping family with school")
+        self.assertEqual(memory["trajectory"], "feeling drained and overwhelmed")
+
+    def test_category_keywords_match_at_word_start_only(self):
+        for text in ("I finished my homework", "the network is down", "apparently it rained"):
+            with self.subTest(text=text):
+                self.assertNotIn("stressor", self.memory_for(text))
+        self.assertEqual(self.memory_for("so many jobs to do")["stressor"], "work stress")
+
+    def test_coping_keywords_match_whole_words_only(self):
+        self.assertEqual(sorted(self.memory_for("music and a walk helped")["coping"]),
+                         ["going for walks", "listening to music"])
+        self.assertEqual(self.memory_for("the team is musical, steady reading")["coping"], [])
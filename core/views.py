@@ -4,19 +4,29 @@ import json
 import uuid
 import logging
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils import timezone
 from django.core.cache import cache
 from django.db.models import Prefetch
-from .gemini_client import generate_reply, update_summary, update_memory
+from .gemini_client import generate_reply, stream_reply, update_summary, update_memory
 from .models import ChatSession, Message, UserPreference
-from django.db import transaction
+from django.db import connection, transaction
 
 AI_SERVICE_URL = os.getenv("AI_SERVICE_URL", "http://127.0.0.1:8001")
 
+# Worker threads for outbound calls that can overlap with database work
+_io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="enoki-io")
+# Summary refreshes are slow Gemini calls; keep them off the pool that serves
+# the RoBERTa call on every request so they can never queue ahead of it
+_summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="enoki-summary")
+# Striped locks so two summary jobs for the same session never interleave
+_summary_locks = [threading.Lock() for _ in range(64)]
+
 # Set up audit logging
 audit_logger = logging.getLogger('audit')
 
@@ -45,83 +55,227 @@ def home(request):
     return render(request, "home.html")
 
 
+def _check_rate_limit(request):
+    """Return a 429 response if the caller is over the rate limit, otherwise record this request."""
+    user_identifier = _get_user_identifier(request)
+    rate_limit_key = f"{RATE_LIMIT_CACHE_PREFIX}{user_identifier}"
+
+    last_request_time = cache.get(rate_limit_key)
+    current_time = time.time()
+
+    if last_request_time:
+        time_since_last_request = current_time - last_request_time
+        if time_since_last_request < RATE_LIMIT_SECONDS:
+            remaining_time = RATE_LIMIT_SECONDS - time_since_last_request
+            return JsonResponse({
+                'error': f'Rate limit exceeded. Please wait {int(remaining_time) + 1} more seconds.',
+                'retry_after': int(remaining_time) + 1
+            }, status=429)
+
+    # Set new rate limit timestamp
+    cache.set(rate_limit_key, current_time, timeout=RATE_LIMIT_SECONDS + 1)
+    return None
+
+
+def _apply_chat_preferences(request, data):
+    """Load preferences and apply any consent / tone / language updates sent with a chat message."""
+    tone = data.get('tone')
+    language = data.get('language')
+    # Allow consent to be provided in request
+    consent_given = data.get('consent')
+
+    # Get preferences (but don't create session yet - depends on consent)
+    prefs = _get_or_create_preferences(request)
+
+    # Handle consent update if provided
+    if consent_given is not None:
+        prefs.data_consent = bool(consent_given)
+        if consent_given:
+            prefs.consent_timestamp = timezone.now()
+        prefs.save()
+        audit_logger.info(
+            f"Consent updated: user_id={getattr(request.user, 'id', 'anon')}, consent={consent_given}")
+
+    # Update preferences if provided
+    updated = False
+    if tone:
+        prefs.tone = tone[:32]
+        updated = True
+    if language:
+        prefs.language = language[:8]
+        updated = True
+    if updated:
+        prefs.save()
+    return prefs
+
+
+def _classify_emotions(user_message):
+    """Classify emotions with RoBERTa (no personal data stored here)."""
+    payload = {"text": user_message}
+    response = httpx.post(
+        f"{AI_SERVICE_URL}/predict_all", json=payload, timeout=30)
+    roberta_data = response.json()
+    return roberta_data.get("emotions", [])
+
+
+def _append_anonymous_history(request, user_message):
+    """Add the user's message to the session-only history (temporary, browser-only)."""
+    session_history = request.session.get('temp_chat_history', [])
+
+    # Add current message to session (temporary storage)
+    session_history.append({"role": "user", "text": user_message})
+
+    # Keep only last 10 messages in session to prevent bloat
+    if len(session_history) > 10:
+        session_history = session_history[-10:]
+    return session_history
+
+
+def _store_anonymous_reply(request, session_history, reply, user_message):
+    """Add the bot reply to the session-only history."""
+    session_history.append({"role": "bot", "text": reply})
+    request.session['temp_chat_history'] = session_history
+
+    audit_logger.info(
+        f"Anonymous chat - no consent: message_length={len(user_message)}")
+
+
+def _prepare_persistent_turn(request):
+    """Resolve the consented user's session and serialize its recent history for the prompt."""
+    session = _get_or_create_session(request)
+
+    # Validate session ownership for security
+    _validate_session_ownership(session, request)
+
+    # Check if we need to migrate session history to database
+    session_history = request.session.get('temp_chat_history', [])
+    if session_history:
+        # Migrate previous anonymous conversation to database
+        with transaction.atomic():
+            for msg in session_history:
+                m = Message(session=session,
+                            sender=msg['role'], text=msg['text'])
+                m.set_plaintext(msg['text'])
+                m.save()
+            # Clear session history after migration
+            del request.session['temp_chat_history']
+            audit_logger.info(
+                f"Migrated anonymous history to database: session_id={session.id}, messages={len(session_history)}")
+
+    # Build prior history for continuity (last 12 messages from THIS SESSION ONLY)
+    # Double-check session ownership for security
+    if request.user.is_authenticated:
+        prior = list(session.messages.filter(
+            session__user=request.user
+        ).order_by('-created_at')[:12])
+    else:
+        anon_id = _get_or_create_anon_id(request)
+        prior = list(session.messages.filter(
+            session__anon_id=anon_id
+        ).order_by('-created_at')[:12])
+
+    prior_serialized = [
+        {"role": m.sender if m.sender in (
+            "user", "bot") else "bot", "text": getattr(m, 'plaintext', m.text)}
+        for m in reversed(prior)
+    ]
+    return session, prior_serialized
+
+
+def _persist_turn(request, session, prior_serialized, user_message, emotions, reply):
+    """Store both messages, evolve the session memory and schedule a summary refresh."""
+    with transaction.atomic():
+        m_user = Message(session=session, sender="user",
+                         text=user_message, emotions=emotions)
+        m_user.set_plaintext(user_message)
+        m_user.save()
+
+        audit_logger.info(
+            f"Message stored: user_id={getattr(request.user, 'id', None)}, session_id={session.id}, action=create_user_message")
+
+        m_bot = Message(session=session, sender="bot", text=reply)
+        m_bot.set_plaintext(reply)
+        m_bot.save()
+
+        audit_logger.info(
+            f"Message stored: user_id={getattr(request.user, 'id', None)}, session_id={session.id}, action=create_bot_message")
+
+        # Invalidate chat sessions cache after saving messages
+        if request.user.is_authenticated:
+            cache.delete(f"chat_sessions_{request.user.id}")
+        else:
+            anon_id = _get_or_create_anon_id(request)
+            cache.delete(f"chat_sessions_anon_{anon_id}")
+
+        # Update summary every 3 user messages (approx)
+        # Let the database count instead of loading every message in the session
+        user_msg_count = session.messages.filter(sender="user").count()
+        turn_history = prior_serialized + [
+            {"role": "user", "text": user_message},
+            {"role": "bot", "text": reply},
+        ]
+        # Always evolve structured memory (local keyword work, cheap enough to do inline)
+        session.memory = update_memory(
+            session.memory,
+            turn_history,
+            user_message,
+            reply,
+        )
+        session.save(update_fields=["memory"])
+
+        # Update summary more frequently early on (first 6 user msgs), then every 3
+        # The summary needs its own Gemini call, so it is queued once the turn commits
+        # and runs on the summary pool after the reply is returned, never ahead of
+        # another request's RoBERTa call
+        if user_msg_count <= 6 or user_msg_count % 3 == 0:
+            transaction.on_commit(
+                lambda: _summary_executor.submit(_refresh_summary, session.id, turn_history, user_message, reply)
+            )
+
+
+def _refresh_summary(session_id, turn_history, user_message, reply):
+    """Background job: fold the latest turn into the stored session summary."""
+    try:
+        with _summary_locks[session_id % len(_summary_locks)]:
+            existing = ChatSession.objects.filter(pk=session_id).values_list("summary", flat=True).first()
+            summary = update_summary(existing, turn_history, user_message, reply)
+            ChatSession.objects.filter(pk=session_id).update(summary=summary)
+    except Exception as e:
+        audit_logger.error(f"Summary update failed: session_id={session_id}, error={str(e)}")
+    finally:
+        # Worker threads get their own DB connection; don't leave it open between jobs
+        connection.close()
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def api_chat(request):
     """API endpoint for testing Gemini + RoBERTa integration with curl"""
     try:
         # Rate limiting check - backend protection
-        user_identifier = _get_user_identifier(request)
-        rate_limit_key = f"{RATE_LIMIT_CACHE_PREFIX}{user_identifier}"
-        
-        last_request_time = cache.get(rate_limit_key)
-        current_time = time.time()
-        
-        if last_request_time:
-            time_since_last_request = current_time - last_request_time
-            if time_since_last_request < RATE_LIMIT_SECONDS:
-                remaining_time = RATE_LIMIT_SECONDS - time_since_last_request
-                return JsonResponse({
-                    'error': f'Rate limit exceeded. Please wait {int(remaining_time) + 1} more seconds.',
-                    'retry_after': int(remaining_time) + 1
-                }, status=429)
-        
-        # Set new rate limit timestamp
-        cache.set(rate_limit_key, current_time, timeout=RATE_LIMIT_SECONDS + 1)
-        
+        rate_limited = _check_rate_limit(request)
+        if rate_limited:
+            return rate_limited
+
         data = json.loads(request.body)
         user_message = data.get('message', '')
-        tone = data.get('tone')
-        language = data.get('language')
-        # Allow consent to be provided in request
-        consent_given = data.get('consent')
 
         if not user_message:
             return JsonResponse({'error': 'Message is required'}, status=400)
 
-        # Get preferences (but don't create session yet - depends on consent)
-        prefs = _get_or_create_preferences(request)
-
-        # Handle consent update if provided
-        if consent_given is not None:
-            prefs.data_consent = bool(consent_given)
-            if consent_given:
-                prefs.consent_timestamp = timezone.now()
-            prefs.save()
-            audit_logger.info(
-                f"Consent updated: user_id={getattr(request.user, 'id', 'anon')}, consent={consent_given}")
-
-        # Update preferences if provided
-        updated = False
-        if tone:
-            prefs.tone = tone[:32]
-            updated = True
-        if language:
-            prefs.language = language[:8]
-            updated = True
-        if updated:
-            prefs.save()
+        prefs = _apply_chat_preferences(request, data)
 
         # Step 1: classify emotions with RoBERTa (no personal data stored here)
-        payload = {"text": user_message}
-        response = httpx.post(
-            f"{AI_SERVICE_URL}/predict_all", json=payload, timeout=30)
-        roberta_data = response.json()
-        emotions = roberta_data.get("emotions", [])
+        # Runs on a worker thread while the history is loaded below
+        emotions_future = _io_executor.submit(_classify_emotions, user_message)
 
         preferences = {"tone": prefs.tone, "language": prefs.language}
 
         # CONSENT CHECK - This determines everything
         if not _check_consent(prefs):
             # NO CONSENT: Use session-only history (temporary, browser-only)
-            session_history = request.session.get('temp_chat_history', [])
-
-            # Add current message to session (temporary storage)
-            session_history.append({"role": "user", "text": user_message})
-
-            # Keep only last 10 messages in session to prevent bloat
-            if len(session_history) > 10:
-                session_history = session_history[-10:]
+            session_history = _append_anonymous_history(request, user_message)
+            emotions = emotions_future.result()
 
             # Generate reply with session-only context
             reply = generate_reply(
@@ -133,12 +287,7 @@ def api_chat(request):
                 memory=None,   # No stored memory
             )
 
-            # Add bot reply to session
-            session_history.append({"role": "bot", "text": reply})
-            request.session['temp_chat_history'] = session_history
-
-            audit_logger.info(
-                f"Anonymous chat - no consent: message_length={len(user_message)}")
+            _store_anonymous_reply(request, session_history, reply, user_message)
 
             return JsonResponse({
                 'user_message': user_message,
@@ -153,43 +302,8 @@ def api_chat(request):
             })
 
         # CONSENT GIVEN: Full database functionality
-        session = _get_or_create_session(request)
-        
-        # Validate session ownership for security
-        _validate_session_ownership(session, request)
-
-        # Check if we need to migrate session history to database
-        session_history = request.session.get('temp_chat_history', [])
-        if session_history:
-            # Migrate previous anonymous conversation to database
-            with transaction.atomic():
-                for msg in session_history:
-                    m = Message(session=session,
-                                sender=msg['role'], text=msg['text'])
-                    m.set_plaintext(msg['text'])
-                    m.save()
-                # Clear session history after migration
-                del request.session['temp_chat_history']
-                audit_logger.info(
-                    f"Migrated anonymous history to database: session_id={session.id}, messages={len(session_history)}")
-
-        # Build prior history for continuity (last 12 messages from THIS SESSION ONLY)
-        # Double-check session ownership for security
-        if request.user.is_authenticated:
-            prior = list(session.messages.filter(
-                session__user=request.user
-            ).order_by('-created_at')[:12])
-        else:
-            anon_id = _get_or_create_anon_id(request)
-            prior = list(session.messages.filter(
-                session__anon_id=anon_id
-            ).order_by('-created_at')[:12])
-        
-        prior_serialized = [
-            {"role": m.sender if m.sender in (
-                "user", "bot") else "bot", "text": getattr(m, 'plaintext', m.text)}
-            for m in reversed(prior)
-        ]
+        session, prior_serialized = _prepare_persistent_turn(request)
+        emotions = emotions_future.result()
 
         # Generate reply with full context - ONLY from current session
         reply = generate_reply(
@@ -202,52 +316,7 @@ def api_chat(request):
         )
 
         # Persist to database
-        with transaction.atomic():
-            m_user = Message(session=session, sender="user",
-                             text=user_message, emotions=emotions)
-            m_user.set_plaintext(user_message)
-            m_user.save()
-
-            audit_logger.info(
-                f"Message stored: user_id={getattr(request.user, 'id', None)}, session_id={session.id}, action=create_user_message")
-
-            m_bot = Message(session=session, sender="bot", text=reply)
-            m_bot.set_plaintext(reply)
-            m_bot.save()
-
-            audit_logger.info(
-                f"Message stored: user_id={getattr(request.user, 'id', None)}, session_id={session.id}, action=create_bot_message")
-            
-            # Invalidate chat sessions cache after saving messages
-            if request.user.is_authenticated:
-                cache.delete(f"chat_sessions_{request.user.id}")
-            else:
-                anon_id = _get_or_create_anon_id(request)
-                cache.delete(f"chat_sessions_anon_{anon_id}")
-
-            # Update summary every 3 user messages (approx)
-            # Use count in memory instead of database query for efficiency
-            user_msg_count = len([m for m in session.messages.all() if m.sender == "user"])
-            # Update summary more frequently early on (first 6 user msgs), then every 3
-            if user_msg_count <= 6 or user_msg_count % 3 == 0:
-                session.summary = update_summary(
-                    session.summary,
-                    prior_serialized +
-                    [{"role": "user", "text": user_message},
-                        {"role": "bot", "text": reply}],
-                    user_message,
-                    reply,
-                )
-            # Always evolve structured memory
-            session.memory = update_memory(
-                session.memory,
-                prior_serialized +
-                [{"role": "user", "text": user_message},
-                    {"role": "bot", "text": reply}],
-                user_message,
-                reply,
-            )
-            session.save(update_fields=["summary", "memory"])
+        _persist_turn(request, session, prior_serialized, user_message, emotions, reply)
 
         return JsonResponse({
             'user_message': user_message,
@@ -265,6 +334,84 @@ def api_chat(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+def _sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def api_chat_stream(request):
+    """Streaming variant of api_chat: sends the reply as Server-Sent Events while Gemini generates it.
+
+    Each event is a JSON object: {"delta": "..."} for reply text, then a final
+    {"done": true, ...} with the same metadata api_chat returns (or {"error": "..."}).
+    """
+    try:
+        rate_limited = _check_rate_limit(request)
+        if rate_limited:
+            return rate_limited
+
+        data = json.loads(request.body)
+        user_message = data.get('message', '')
+
+        if not user_message:
+            return JsonResponse({'error': 'Message is required'}, status=400)
+
+        prefs = _apply_chat_preferences(request, data)
+        emotions_future = _io_executor.submit(_classify_emotions, user_message)
+        preferences = {"tone": prefs.tone, "language": prefs.language}
+
+        if not _check_consent(prefs):
+            session = None
+            history = _append_anonymous_history(request, user_message)
+        else:
+            session, history = _prepare_persistent_turn(request)
+        emotions = emotions_future.result()
+    except Exception as e:
+        audit_logger.error(f"Chat stream error: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+    def event_stream():
+        try:
+            parts = []
+            for piece in stream_reply(
+                user_message,
+                emotions,
+                preferences,
+                history=history,
+                summary=session.summary if session else None,
+                memory=session.memory if session else None,
+            ):
+                parts.append(piece)
+                yield _sse_event({'delta': piece})
+            reply = "".join(parts)
+
+            if session is None:
+                _store_anonymous_reply(request, history, reply, user_message)
+                # SessionMiddleware already ran when the response started, so save explicitly
+                request.session.save()
+            else:
+                _persist_turn(request, session, history, user_message, emotions, reply)
+
+            yield _sse_event({
+                'done': True,
+                'emotions': emotions[:5],
+                'session_id': session.id if session else None,
+                'preferences': preferences,
+                'summary': session.summary if session else None,
+                'memory': session.memory if session else None,
+                'consent_required': session is None,
+            })
+        except Exception as e:
+            audit_logger.error(f"Chat stream error: {str(e)}")
+            yield _sse_event({'error': str(e)})
+
+    response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
 def api_chat_history(request):
@@ -303,6 +450,7 @@ def api_chat_history(request):
             msgs = session.messages.filter(
                 session__anon_id=anon_id
             ).order_by('-created_at')[:limit]
+        msgs = Message.bulk_decrypt(msgs)
         
         serialized = [
             {
@@ -584,36 +732,8 @@ def chat(request):
                 memory=session.memory,
             )
 
-            # Persist messages atomically
-            with transaction.atomic():
-                m_user = Message(session=session, sender="user",
-                                 text=user_message, emotions=emotions)
-                m_user.set_plaintext(user_message)
-                m_user.save()
-                m_bot = Message(session=session, sender="bot",
-                                text=reply, emotions=None)
-                m_bot.set_plaintext(reply)
-                m_bot.save()
-                # Use count in memory instead of database query for efficiency
-                user_msg_count = len([m for m in session.messages.all() if m.sender == "user"])
-                if user_msg_count <= 6 or user_msg_count % 3 == 0:
-                    session.summary = update_summary(
-                        session.summary,
-                        prior_serialized +
-                        [{"role": "user", "text": user_message},
-                            {"role": "bot", "text": reply}],
-                        user_message,
-                        reply,
-                    )
-                session.memory = update_memory(
-                    session.memory,
-                    prior_serialized +
-                    [{"role": "user", "text": user_message},
-                        {"role": "bot", "text": reply}],
-                    user_message,
-                    reply,
-                )
-                session.save(update_fields=["summary", "memory"])
+            # Persist messages atomically, same path as the API views
+            _persist_turn(request, session, prior_serialized, user_message, emotions, reply)
 
     # Get recent messages to display in template
     if _check_consent(prefs) and session:
@@ -888,7 +1008,7 @@ def api_chat_session_detail(request, session_id):
             anon_id = _get_or_create_anon_id(request)
             session = ChatSession.objects.get(id=session_id, anon_id=anon_id)
 
-        messages = session.messages.order_by('created_at')
+        messages = Message.bulk_decrypt(session.messages.order_by('created_at'))
         message_list = []
         for msg in messages:
             message_list.append({
@@ -17,7 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from core.views import (
-    home, chat, api_chat, api_chat_history, api_chat_context,
+    home, chat, api_chat, api_chat_stream, api_chat_history, api_chat_context,
     api_new_chat, api_chat_sessions, api_chat_session_detail, api_switch_session, api_current_session,
     api_consent, api_consent_status, api_clear_anonymous_chat, api_delete_session, api_save_messages
 )
@@ -33,6 +33,7 @@ urlpatterns = [
     path('oauth/', include('social_django.urls', namespace='social')),  # OAuth URLs
     path('chat/', chat, name='chat'),
     path('api/chat/', api_chat, name='api_chat'),
+    path('api/chat/stream/', api_chat_stream, name='api_chat_stream'),
     path('api/chat/history/', api_chat_sessions, name='api_chat_sessions'),  # Updated to use new function
     path('api/chat/context/', api_chat_context, name='api_chat_context'),
     path('api/chat/new/', api_new_chat, name='api_new_chat'),
@@ -901,13 +901,8 @@ document.addEventListener("DOMContentLoaded", function () {
     return d.toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" });
   }
 
-  // Append a message to the chat display
-  async function appendMessage({ sender, text, timeStr = null, isExisting = false }) {
-    // Clear intro when user sends first message
-    if (sender === "user") {
-      clearIntroMessage();
-    }
-
+  // Add an empty message bubble to the chat display and return its text element
+  function createMessageElement(sender, timeStr = null) {
     const isUser = sender === "user";
     const wrapper = document.createElement("div");
     wrapper.className = `chat-message ${isUser ? "user-chat" : "bot-chat"}`;
@@ -918,12 +913,24 @@ document.addEventListener("DOMContentLoaded", function () {
             <div class="message-text"></div>
             <div class="message-time">${timeStr || fmtTime()}</div>
         `;
-
-    // Escape HTML and preserve line breaks
-    const escapedText = escapeHtml(text).replace(/\n/g, "<br>");
-    content.querySelector(".message-text").innerHTML = escapedText;
     wrapper.appendChild(content);
     chatMessages.appendChild(wrapper);
+    return content.querySelector(".message-text");
+  }
+
+  // Escape HTML and preserve line breaks
+  function setMessageText(textEl, text) {
+    textEl.innerHTML = escapeHtml(text).replace(/\n/g, "<br>");
+  }
+
+  // Append a message to the chat display
+  async function appendMessage({ sender, text, timeStr = null, isExisting = false }) {
+    // Clear intro when user sends first message
+    if (sender === "user") {
+      clearIntroMessage();
+    }
+
+    setMessageText(createMessageElement(sender, timeStr), text);
 
     // Persist message to anonymous session if applicable (but only for new messages, not existing ones)
     if (!isExisting) {
@@ -933,6 +940,29 @@ document.addEventListener("DOMContentLoaded", function () {
     scrollToBottom();
   }
 
+  // Read a Server-Sent Events response, calling onEvent with each parsed JSON event
+  async function readEventStream(res, onEvent) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        const event = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        const data = event
+          .split("\n")
+          .filter((line) => line.startsWith("data: "))
+          .map((line) => line.slice(6))
+          .join("\n");
+        if (data) await onEvent(JSON.parse(data));
+      }
+    }
+  }
+
   // Display animated thinking indicator while bot processes
   function showThinkingIndicator() {
     const wrapper = document.createElement("div");
@@ -1082,7 +1112,8 @@ document.addEventListener("DOMContentLoaded", function () {
       // Show thinking indicator
       showThinkingIndicator();
 
-      const res = await fetch("/api/chat/", {
+      // The reply streams in sentence by sentence as Gemini writes it
+      const res = await fetch("/api/chat/stream/", {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -1091,29 +1122,54 @@ document.addEventListener("DOMContentLoaded", function () {
         credentials: "same-origin",
         body: JSON.stringify(payload),
       });
-      const data = await res.json();
 
-      // Handle rate limit from backend
-      if (res.status === 429) {
-        hideThinkingIndicator();
-        await appendMessage({
-          sender: "bot",
-          text: `⏱️ ${data.error || "Please wait before sending another message."}`,
-        });
-        // Update last message time to prevent bypass
-        lastMessageTime = Date.now();
-        if (data.retry_after) {
-          startCooldownTimer();
+      // Rate limits and request errors come back as plain JSON instead of a stream
+      if (!(res.headers.get("Content-Type") || "").includes("text/event-stream")) {
+        const errorData = await res.json();
+
+        // Handle rate limit from backend
+        if (res.status === 429) {
+          hideThinkingIndicator();
+          await appendMessage({
+            sender: "bot",
+            text: `⏱️ ${errorData.error || "Please wait before sending another message."}`,
+          });
+          // Update last message time to prevent bypass
+          lastMessageTime = Date.now();
+          if (errorData.retry_after) {
+            startCooldownTimer();
+          }
+          return;
         }
-        return;
+
+        throw new Error(errorData.error || `HTTP ${res.status}`);
       }
 
-      if (!res.ok || data.error) throw new Error(data.error || `HTTP ${res.status}`);
+      let reply = "";
+      let replyEl = null;
+      let data = null;
+      await readEventStream(res, async (event) => {
+        if (event.error) throw new Error(event.error);
+        if (event.delta) {
+          if (!replyEl) {
+            // Hide thinking indicator once the first sentence arrives
+            hideThinkingIndicator();
+            replyEl = createMessageElement("bot");
+          }
+          reply += event.delta;
+          setMessageText(replyEl, reply);
+          scrollToBottom();
+        }
+        if (event.done) data = event;
+      });
+      if (!data) throw new Error("The reply stream ended unexpectedly");
 
-      // Hide thinking indicator
       hideThinkingIndicator();
-
-      await appendMessage({ sender: "bot", text: data.reply });
+      if (replyEl) {
+        await addMessageToAnonymousSession("bot", reply);
+      } else {
+        await appendMessage({ sender: "bot", text: reply });
+      }
 
       // Update last message time AFTER successful response
       lastMessageTime = Date.now();